@@ -0,0 +1,57 @@
+""" Compare the JSON backends of the decoder.
+
+Run from the repository root:
+    python benchmarks/bench_backends.py [capture file]
+
+Without a capture file the sample payloads are used. Only the installed
+backends (json, and orjson or ujson when present) are measured.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pysmartweatherudp.backends import BACKENDS
+from pysmartweatherudp.capture import readCapture
+from pysmartweatherudp.decoder import Decoder, peekType
+
+from samples import PAYLOADS
+
+NUMBER = 20000
+
+
+def loadPackets(path):
+    """ Returns the packets of a capture by message type. """
+    packets = {}
+    for _, data in readCapture(path):
+        packets.setdefault(peekType(data) or 'unknown', []).append(data)
+    return packets
+
+
+def main():
+    if len(sys.argv) > 1:
+        packets = loadPackets(sys.argv[1])
+    else:
+        packets = dict((msg_type, [data]) for msg_type, data in PAYLOADS.items())
+    backends = sorted(BACKENDS)
+    decoders = dict((name, Decoder('metric', name)) for name in backends)
+    print('%-14s' % 'us/packet' + ''.join('%10s' % name for name in backends))
+    for msg_type, datas in sorted(packets.items()):
+        number = max(1, NUMBER // len(datas))
+        row = '%-14s' % msg_type
+        for name in backends:
+            decode = decoders[name].decode
+            def run():
+                for data in datas:
+                    try:
+                        decode(data)
+                    except ValueError:
+                        pass
+            elapsed = timeit.timeit(run, number=number)
+            row += '%10.2f' % (elapsed / (number * len(datas)) * 1e6)
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
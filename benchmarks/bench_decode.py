@@ -0,0 +1,40 @@
+""" Micro-benchmark of the per packet decode cost.
+
+Run from the repository root:
+    python benchmarks/bench_decode.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pysmartweatherudp import utils
+from pysmartweatherudp.decoder import Decoder
+
+from samples import PAYLOADS
+
+NUMBER = 20000
+
+
+def legacy(data, units):
+    """ The old path: getDataSet followed by a second json.loads. """
+    ds = utils.getDataSet(data, units, ignore_errors=True)
+    json.loads(data)['type']
+    return ds
+
+
+def main():
+    for units in ('metric', 'imperial'):
+        decoder = Decoder(units)
+        print('units: %s' % units)
+        for msg_type, data in PAYLOADS.items():
+            old = timeit.timeit(lambda: legacy(data, units), number=NUMBER)
+            new = timeit.timeit(lambda: decoder.decode(data), number=NUMBER)
+            print('  %-10s legacy %6.2f us  decoder %6.2f us' % (
+                msg_type, old / NUMBER * 1e6, new / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+""" Find the packet rate the receiver keeps up with.
+
+Run from the repository root:
+    python benchmarks/bench_load.py [--stations 50] [--start 1000] [--max 64000]
+
+A simulator process sends to an SWReceiver in this process over
+localhost, doubling the rate every step until more than --loss percent
+of the packets are lost. Each step reports the achieved send rate, the
+loss and the latency from sending to the callback.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pysmartweatherudp import SWReceiver
+from pysmartweatherudp.decoder import MESSAGE_TYPES
+from pysmartweatherudp.simulator import send
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def sender(results, port, rate, duration, options):
+    results.put(send('127.0.0.1', port, rate, duration, precise=True, **options))
+
+
+class Collector:
+    """ Counts the datasets of a step, by (serial_number, type, timestamp). """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.keys = set()
+        self.datasets = 0
+        self.latencies = []
+
+    def __call__(self, ds):
+        now = time.time()
+        with self.lock:
+            self.datasets += 1
+            self.keys.add((ds.serial_number, ds.type, ds.timestamp))
+            self.latencies.append(now - ds.timestamp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=50299)
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--start', type=float, default=1000, help='first rate in packets/s')
+    parser.add_argument('--max', type=float, default=64000, help='highest rate tried')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per step')
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--loss', type=float, default=1.0, help='percent of loss that ends the run')
+    parser.add_argument('--malformed', type=float, default=0.0)
+    parser.add_argument('--duplicates', type=float, default=0.0)
+    parser.add_argument('--rcvbuf', type=int)
+    args = parser.parse_args()
+
+    receiver = SWReceiver(host='127.0.0.1', port=args.port, rcvbuf=args.rcvbuf)
+    collector = Collector()
+    receiver.registerCallback(collector, types=sorted(MESSAGE_TYPES))
+    receiver.start()
+    options = dict(stations=args.stations, burst=args.burst, malformed=args.malformed,
+                   duplicates=args.duplicates)
+    results = multiprocessing.Queue()
+    limit = None
+    print('%10s %10s %10s %8s %10s %10s %8s' % (
+        'target/s', 'sent/s', 'received', 'loss %', 'p50 ms', 'p99 ms', 'errors'))
+    try:
+        rate = args.start
+        while rate <= args.max:
+            with collector.lock:
+                collector.reset()
+            errors = sum(receiver.stats.errors.values())
+            process = multiprocessing.Process(target=sender,
+                                              args=(results, args.port, rate, args.duration, options))
+            start = time.time()
+            process.start()
+            sent = results.get()
+            elapsed = time.time() - start
+            process.join()
+            # let the receiver drain its queue
+            time.sleep(0.5)
+            with collector.lock:
+                received = len(collector.keys)
+                latencies = list(collector.latencies)
+            valid = sent.get('valid', 0)
+            loss = 100.0 * (valid - received) / valid if valid else 0.0
+            print('%10.0f %10.0f %10d %8.2f %10.2f %10.2f %8d' % (
+                rate, sum(sent.values()) / elapsed, received, loss,
+                percentile(latencies, 50) * 1e3 if latencies else 0,
+                percentile(latencies, 99) * 1e3 if latencies else 0,
+                sum(receiver.stats.errors.values()) - errors))
+            if loss > args.loss:
+                break
+            limit = rate
+            rate *= 2
+    finally:
+        receiver.stop()
+    if limit is None:
+        print('lost more than %.1f%% already at %.0f packets/s' % (args.loss, args.start))
+    else:
+        print('keeps up with %.0f packets/s (%d stations)' % (limit, args.stations))
+
+
+if __name__ == '__main__':
+    main()
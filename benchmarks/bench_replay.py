@@ -0,0 +1,80 @@
+""" Replay a capture through the receiver pipeline and report throughput.
+
+Run from the repository root:
+    python benchmarks/bench_replay.py [capture file] [packets]
+
+Without a capture file a temporary one is made from the sample payloads.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pysmartweatherudp.capture import Recorder, replay
+from pysmartweatherudp.constants import DEDUP_WINDOW
+from pysmartweatherudp.pipeline import Pipeline
+
+from samples import PAYLOADS
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+def makeCapture(path, packets):
+    """ Write a capture cycling through the sample payloads. """
+    payloads = list(PAYLOADS.values())
+    start = time.time()
+    with Recorder(path) as recorder:
+        for i in range(packets):
+            recorder.write(payloads[i % len(payloads)], start + i * 0.01)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main():
+    packets = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+        cleanup = False
+    else:
+        handle, path = tempfile.mkstemp(suffix='.swcap')
+        os.close(handle)
+        os.remove(path)
+        makeCapture(path, packets)
+        cleanup = True
+
+    # the generated capture repeats the same few packets, which would
+    # otherwise all be dropped as duplicates
+    pipeline = Pipeline('metric', dedup_window=None if cleanup else DEDUP_WINDOW)
+    latencies = []
+    received = [0.0]
+
+    def handler(data):
+        received[0] = clock()
+        pipeline.handle(data)
+
+    pipeline.registerCallback(lambda ds: latencies.append(clock() - received[0]))
+
+    start = clock()
+    count = replay(path, handler)
+    elapsed = clock() - start
+    if cleanup:
+        os.remove(path)
+
+    print('datagrams  %d' % count)
+    print('datasets   %d' % len(latencies))
+    print('rate       %.0f packets/s' % (count / elapsed))
+    if latencies:
+        print('p50        %.1f us' % (percentile(latencies, 50) * 1e6))
+        print('p99        %.1f us' % (percentile(latencies, 99) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
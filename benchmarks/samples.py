@@ -0,0 +1,25 @@
+""" Sample WeatherFlow UDP payloads used by the benchmarks. """
+
+RAPID_WIND = b'{"serial_number":"SK-00008453","type":"rapid_wind","hub_sn":"HB-00000001","ob":[1493322445,2.3,128]}'
+OBS_AIR = b'{"serial_number":"AR-00004049","type":"obs_air","hub_sn":"HB-00000001","obs":[[1493164835,835.0,10.0,45,0,0,3.46,1]],"firmware_revision":17}'
+OBS_SKY = b'{"serial_number":"SK-00008453","type":"obs_sky","hub_sn":"HB-00000001","obs":[[1493321340,9000,10,0.0,2.6,4.6,7.4,187,3.12,1,130,null,0,3]],"firmware_revision":29}'
+OBS_ST = b'{"serial_number":"ST-00000512","type":"obs_st","hub_sn":"HB-00013030","obs":[[1588948614,0.18,0.22,0.27,144,6,1017.57,22.37,50.26,328,0.03,3,0.000000,0,0,0,2.410,1]],"firmware_revision":129}'
+
+PAYLOADS = {
+    'rapid_wind': RAPID_WIND,
+    'obs_air': OBS_AIR,
+    'obs_sky': OBS_SKY,
+    'obs_st': OBS_ST,
+}
+
+EVT_STRIKE = b'{"serial_number":"AR-00004049","type":"evt_strike","hub_sn":"HB-00000001","evt":[1493322445,27,3848]}'
+EVT_PRECIP = b'{"serial_number":"SK-00008453","type":"evt_precip","hub_sn":"HB-00000001","evt":[1493322445]}'
+DEVICE_STATUS = b'{"serial_number":"AR-00004049","type":"device_status","hub_sn":"HB-00000001","timestamp":1510855923,"uptime":2189,"voltage":3.50,"firmware_revision":17,"rssi":-17,"hub_rssi":-87,"sensor_status":0,"debug":0}'
+HUB_STATUS = b'{"serial_number":"HB-00000001","type":"hub_status","firmware_revision":"35","uptime":1670133,"rssi":-62,"timestamp":1495724691,"reset_flags":"BOR,PIN,POR","seq":48,"fs":[1,0,15675411,524288],"radio_stats":[2,1,0,3,2839],"mqtt_stats":[1,0]}'
+
+EVENTS = {
+    'evt_strike': EVT_STRIKE,
+    'evt_precip': EVT_PRECIP,
+    'device_status': DEVICE_STATUS,
+    'hub_status': HUB_STATUS,
+}
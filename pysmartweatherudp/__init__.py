@@ -2,3 +2,8 @@
 name="pysmartweatherudp"
 
 from .receiver import SWReceiver
+try:
+    from .aio import AsyncSWReceiver
+except (ImportError, SyntaxError):
+    # asyncio receiver needs Python 3.7+
+    pass
@@ -0,0 +1,159 @@
+""" asyncio interface to receive UDP packages from a Smart Weather station. """
+import asyncio
+
+from .pipeline import Pipeline
+from .receiver import createSocket
+from .stats import MetricsServer, clock
+
+from .constants import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    DEFAULT_UNITS,
+    DEDUP_WINDOW,
+    DROP_OLDEST
+)
+
+_STOP = object()
+
+
+class SWProtocol(asyncio.DatagramProtocol):
+    """ Feeds the datagrams of one socket into an AsyncSWReceiver. """
+    def __init__(self, receiver):
+        self._receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self._receiver._datagramReceived(data)
+
+    def error_received(self, exc):
+        # ICMP errors on a listening socket carry no useful information
+        pass
+
+
+class AsyncSWReceiver:
+    """
+    Receive Smart Weather packets on the running event loop.
+
+    Datasets are passed to the registered callbacks and put on a bounded
+    queue, which can be read with get() or by iterating the receiver.
+    The queue gets the message types listed in types, observations by
+    default:
+
+        async with AsyncSWReceiver() as receiver:
+            async for ds in receiver:
+                ...
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, units=DEFAULT_UNITS, maxsize=100,
+                 rcvbuf=None, recorder=None,
+                 store=None, wind_windows=None, types=None, backend=None,
+                 dedup_window=DEDUP_WINDOW, keep_state=True):
+        self.host = host
+        self.port = port
+        self.units = units
+        self.rcvbuf = rcvbuf
+        # Optional capture.Recorder that gets every raw datagram
+        self.recorder = recorder
+        self._pipeline = Pipeline(units, store, wind_windows, backend, dedup_window, keep_state)
+        # Last read state per station
+        self.stations = self._pipeline.stations
+        # Counters and histograms, see stats.ReceiverStats
+        self.stats = self._pipeline.stats
+        self._queue = asyncio.Queue(maxsize)
+        # the queue is fed like any other callback
+        self._pipeline.registerCallback(self._put, types=types)
+        self._transport = None
+        self.stopped = False
+        self.dropped = 0
+
+    def registerCallback(self, callback, station=None, queue_size=None, overflow=DROP_OLDEST,
+                         types=None, units=None):
+        """
+        Register a callback for every dataset, or only for the datasets
+        from one station, given by its hub_sn or a device serial_number.
+        With queue_size the callback runs on its own worker thread, types
+        selects the message types, observations by default, and units the
+        unit system of its datasets, the receiver's by default.
+        """
+        return self._pipeline.registerCallback(callback, station, queue_size, overflow, types,
+                                               units)
+
+    def snapshot(self, station, units=None):
+        """
+        Returns the frozen StationSnapshot of the latest state of a
+        station, given by its hub_sn or a device serial_number, or None.
+        It can be called from any thread and never blocks the receiver.
+        units selects the unit system, the receiver's by default.
+        """
+        return self._pipeline.snapshot(station, units)
+
+    def registerMetric(self, name, function=None, fields=None):
+        """
+        Add a metric computed from the fields of every observation,
+        found in ds.metrics[name]. See metrics.MetricRegistry.
+        """
+        self._pipeline.registerMetric(name, function, fields)
+
+    def serveMetrics(self, port=9222, host='127.0.0.1'):
+        """
+        Serve the counters in the Prometheus text format on
+        http://host:port/metrics. Returns the stats.MetricsServer.
+        """
+        return MetricsServer(self.stats, host, port)
+
+    async def start(self):
+        """ Bind the socket and start receiving. """
+        sock = createSocket(self.host, self.port, self.rcvbuf)
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: SWProtocol(self), sock=sock)
+
+    def stop(self):
+        """ Close the socket and wake up anyone waiting for a dataset. """
+        if self.stopped:
+            return
+        self.stopped = True
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        self._pipeline.close()
+        self._put(_STOP)
+
+    async def get(self):
+        """ Returns the next dataset, or None once the receiver is stopped. """
+        if self.stopped and self._queue.empty():
+            return None
+        ds = await self._queue.get()
+        if ds is _STOP:
+            # leave the marker for other waiters
+            self._put(_STOP)
+            return None
+        return ds
+
+    def _datagramReceived(self, data):
+        received = clock()
+        if self.recorder is not None:
+            self.recorder.write(data)
+        self._pipeline.handle(data, received)
+        self.stats.batch(1)
+
+    def _put(self, item):
+        # drop the oldest dataset rather than stall the event loop
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        ds = await self.get()
+        if ds is None:
+            raise StopAsyncIteration
+        return ds
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.stop()
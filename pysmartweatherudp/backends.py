@@ -0,0 +1,27 @@
+""" JSON parsers for the packets, the fastest installed one by default. """
+import json
+
+# name: loads function, for the parsers that are installed
+BACKENDS = {'json': json.loads}
+
+try:
+    import orjson
+    BACKENDS['orjson'] = orjson.loads
+except ImportError:
+    pass
+
+try:
+    import ujson
+    BACKENDS['ujson'] = ujson.loads
+except ImportError:
+    pass
+
+DEFAULT_BACKEND = [name for name in ('orjson', 'ujson', 'json') if name in BACKENDS][0]
+
+
+def getLoads(backend=None):
+    """ Returns the loads function of a backend, the default one for None. """
+    try:
+        return BACKENDS[backend or DEFAULT_BACKEND]
+    except KeyError:
+        raise ValueError('JSON backend %s is not installed' % backend)
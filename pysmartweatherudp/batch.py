@@ -0,0 +1,54 @@
+""" Columnar decoding of packets that carry several observation rows. """
+from . import utils
+from .metrics import numpy, dewPoints, heatIndices
+
+# Raw column of temperature and humidity for the types with derived values
+DERIVED_COLUMNS = {
+    'obs_air': (2, 3),
+    'obs_st': (7, 8),
+}
+
+
+class ObservationBatch:
+    """
+    All rows of an obs array, kept as columns of raw values. Derived
+    values are computed for the whole batch at once, vectorized when
+    NumPy is installed.
+    """
+    def __init__(self, msg_type, rows, units):
+        cls, _, _ = utils.DATASET_TYPES[msg_type]
+        self.msg_type = msg_type
+        self._cls = cls
+        self._conv = utils.getConverters(units)
+        self.rows = rows
+        # columns[i] holds field i of every row
+        self.columns = list(zip(*rows))
+        self.dewpoint = None
+        self.heat_index = None
+        derived = DERIVED_COLUMNS.get(msg_type)
+        if derived is not None:
+            temperature = self.columns[derived[0]]
+            humidity = self.columns[derived[1]]
+            self.dewpoint = dewPoints(temperature, humidity)
+            self.heat_index = heatIndices(temperature, humidity)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, index):
+        """ Returns a raw column, as a NumPy array when NumPy is installed. """
+        if numpy is None:
+            return list(self.columns[index])
+        return numpy.asarray(self.columns[index], dtype=float)
+
+    def datasets(self):
+        """ Returns a dataset per row, in the order of the obs array. """
+        if self.dewpoint is None:
+            return [self._cls(row, self._conv) for row in self.rows]
+        datasets = []
+        for row, dewpoint, heat_index in zip(self.rows, self.dewpoint, self.heat_index):
+            ds = self._cls(row, self._conv, derived=False)
+            ds.dewpoint = dewpoint
+            ds.heat_index = heat_index
+            datasets.append(ds)
+        return datasets
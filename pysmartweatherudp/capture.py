@@ -0,0 +1,97 @@
+""" Record raw datagrams and replay them through the receiver pipeline. """
+import base64
+import json
+import struct
+import time
+
+# Binary capture: the magic, then for every datagram a little endian
+# double arrival time and unsigned short length, followed by the bytes.
+MAGIC = b'SWUDP1\n'
+_RECORD = struct.Struct('<dH')
+
+
+class Recorder:
+    """
+    Append raw datagrams with their arrival time to a capture file.
+    Files ending in .jsonl are written as JSON lines, anything else in
+    the compact binary format.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = path.endswith('.jsonl')
+        self.count = 0
+        self._file = open(path, 'ab')
+        if not self.jsonl and self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, data, timestamp=None):
+        """ Append a datagram, stamped with the current time by default. """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.jsonl:
+            line = json.dumps({'time': timestamp, 'data': base64.b64encode(data).decode('ascii')})
+            self._file.write(line.encode('utf-8') + b'\n')
+        else:
+            self._file.write(_RECORD.pack(timestamp, len(data)))
+            self._file.write(data)
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def readCapture(path):
+    """ Yields (arrival time, datagram) for every record of a capture file. """
+    with open(path, 'rb') as capture:
+        if path.endswith('.jsonl'):
+            for line in capture:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['time'], base64.b64decode(record['data'])
+            return
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a capture file: %s' % path)
+        while True:
+            header = capture.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            timestamp, length = _RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                # truncated by a crash while recording
+                return
+            yield timestamp, data
+
+
+def replay(path, handler, realtime=False, speed=1.0):
+    """
+    Feed a capture to handler, normally SWReceiver.feed or
+    Pipeline.handle, as fast as possible or at the recorded pace divided
+    by speed. Packets that fail to decode are skipped. Returns the number
+    of datagrams replayed.
+    """
+    count = 0
+    first = start = None
+    for timestamp, data in readCapture(path):
+        if realtime:
+            if first is None:
+                first = timestamp
+                start = time.time()
+            delay = (timestamp - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            handler(data)
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass
+        count += 1
+    return count
@@ -1,3 +1,16 @@
 DEFAULT_HOST = '0.0.0.0'
 DEFAULT_PORT = 50222
 DEFAULT_UNITS = 'metric'
+# Values as sent by WeatherFlow: mm, mb, m/s, km, kept unrounded
+RAW_UNITS = 'raw'
+DEFAULT_BATCH_SIZE = 64
+MAX_DATAGRAM_SIZE = 4096
+# Seconds a datagram may arrive late before it is dropped as stale
+DEDUP_WINDOW = 120
+# Seconds a timestamp may be ahead of the local clock before it is dropped
+MAX_CLOCK_SKEW = 120
+
+# Overflow policies for queued callbacks
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
@@ -0,0 +1,182 @@
+""" Single pass decoding of Smart Weather UDP packets. """
+import operator
+import re
+
+from . import utils
+from .backends import getLoads
+from .batch import ObservationBatch
+from .events import EVENT_TYPES
+
+OBSERVATION_TYPES = frozenset(utils.DATASET_TYPES)
+MESSAGE_TYPES = OBSERVATION_TYPES | frozenset(EVENT_TYPES)
+
+_TYPE_PATTERN = re.compile(br'"type"\s*:\s*"([a-z_]+)"')
+_HUB_PATTERN = re.compile(br'"hub_sn"\s*:\s*"([^"]*)"')
+_SERIAL_PATTERN = re.compile(br'"serial_number"\s*:\s*"([^"]*)"')
+# first value of the ob, obs or evt array, or the timestamp of status messages
+_TIME_PATTERN = re.compile(br'"(?:obs?|evt)"\s*:\s*\[[\s\[]*(-?[0-9.]+)|"timestamp"\s*:\s*(-?[0-9.]+)')
+
+# Shortest valid row of each message type carrying an array, and the
+# indexes that must hold numbers because they are converted or compared
+ROW_SCHEMAS = {
+    'rapid_wind': (3, (0, 1, 2)),
+    'obs_sky': (11, (0, 3, 4, 5, 6, 7)),
+    'obs_air': (7, (0, 1, 2, 3, 4, 5)),
+    'obs_st': (17, (0, 1, 2, 4, 6, 7, 8, 12, 14, 15)),
+    'evt_strike': (3, (0, 1)),
+    'evt_precip': (1, (0,)),
+}
+
+_NUMBERS = (int, float)
+
+
+def makeRowCheck(length, numbers):
+    """
+    Returns a function telling whether a row is a list of at least length
+    values with numbers at the given indexes. Once a row passed, the
+    dataset classes can index it without failing.
+    """
+    if len(numbers) == 1:
+        index = numbers[0]
+        fetch = lambda row: (row[index],)
+    else:
+        fetch = operator.itemgetter(*numbers)
+    def check(row):
+        if row.__class__ is not list or len(row) < length:
+            return False
+        for value in fetch(row):
+            if value.__class__ not in _NUMBERS:
+                return False
+        return True
+    return check
+
+
+def peekType(data):
+    """ Returns the message type of a raw packet without parsing it, or None. """
+    if not isinstance(data, (bytes, bytearray)):
+        data = data.encode('utf-8')
+    match = _TYPE_PATTERN.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+
+def peekStation(data):
+    """
+    Returns the hub_sn of a raw packet without parsing it, the
+    serial_number for packets from the hub itself, or None.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = data.encode('utf-8')
+    match = _HUB_PATTERN.search(data) or _SERIAL_PATTERN.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+
+def peekSerial(data):
+    """ Returns the serial_number of a raw packet without parsing it, or None. """
+    if not isinstance(data, (bytes, bytearray)):
+        data = data.encode('utf-8')
+    match = _SERIAL_PATTERN.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+
+def peekTimestamp(data):
+    """
+    Returns the timestamp of a raw packet without parsing it, the one of
+    the first row for packets with several, or None.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = data.encode('utf-8')
+    match = _TIME_PATTERN.search(data)
+    if match is None:
+        return None
+    try:
+        return float(match.group(1) or match.group(2))
+    except ValueError:
+        return None
+
+
+class Decoder:
+    """
+    Parse each datagram exactly once and dispatch on its message type.
+    The unit converters and the row checks are resolved when the decoder
+    is built. backend names the JSON parser, see backends.BACKENDS.
+    """
+    def __init__(self, units, backend=None):
+        self.units = units
+        self._conv = utils.getConverters(units)
+        self._loads = getLoads(backend)
+        self._handlers = {}
+        for msg_type, (cls, key, rows) in utils.DATASET_TYPES.items():
+            self._handlers[msg_type] = self._makeHandler(msg_type, cls, key, rows)
+        for msg_type, (cls, key) in EVENT_TYPES.items():
+            self._handlers[msg_type] = self._makeEventHandler(msg_type, cls, key)
+
+    def _makeHandler(self, msg_type, cls, key, rows):
+        conv = self._conv
+        check = makeRowCheck(*ROW_SCHEMAS[msg_type])
+        if not rows:
+            def handler(jsondata):
+                row = jsondata.get(key)
+                if not check(row):
+                    return None
+                return [cls(row, conv)]
+            return handler
+        def handler(jsondata):
+            obs = jsondata.get(key)
+            if obs.__class__ is not list or not obs:
+                return None
+            for row in obs:
+                if not check(row):
+                    return None
+            if len(obs) == 1:
+                return [cls(obs[0], conv)]
+            # hubs that reconnect and replays send several rows at once
+            return ObservationBatch(msg_type, obs, conv).datasets()
+        return handler
+
+    def _makeEventHandler(self, msg_type, cls, key):
+        conv = self._conv
+        if key is None:
+            return lambda jsondata: [cls(jsondata, conv)]
+        check = makeRowCheck(*ROW_SCHEMAS[msg_type])
+        def handler(jsondata):
+            row = jsondata.get(key)
+            if not check(row):
+                return None
+            return [cls(row, conv)]
+        return handler
+
+    def decode(self, data, wanted=None):
+        """
+        Returns (message type, datasets) with a dataset for every row of
+        the packet, in order. Datasets is empty for unknown types, and for
+        types not in wanted, which are skipped before the JSON is parsed.
+        It is None for packets that do not match the row schema of their
+        type. Raises ValueError when the packet is not JSON.
+        """
+        if wanted is not None:
+            msg_type = peekType(data)
+            if msg_type is not None and msg_type not in wanted:
+                return msg_type, []
+        jsondata = self._loads(data)
+        if jsondata.__class__ is not dict:
+            return None, None
+        msg_type = jsondata.get('type')
+        handler = self._handlers.get(msg_type)
+        if handler is None:
+            return msg_type, []
+        datasets = handler(jsondata)
+        if datasets is None:
+            return msg_type, None
+        serial_number = jsondata.get('serial_number')
+        # hub_status comes from the hub itself
+        hub_sn = jsondata.get('hub_sn', serial_number)
+        for ds in datasets:
+            ds.serial_number = serial_number
+            ds.hub_sn = hub_sn
+        return msg_type, datasets
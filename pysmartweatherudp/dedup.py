@@ -0,0 +1,106 @@
+""" Suppression of duplicate and stale datagrams and observation rows. """
+import collections
+import time
+import zlib
+
+from .decoder import OBSERVATION_TYPES, peekSerial, peekTimestamp, peekType
+from .constants import DEDUP_WINDOW, MAX_CLOCK_SKEW
+
+
+class _Seen(object):
+    """ The last identifiers seen for a device and message type. """
+    __slots__ = ('newest', 'order', 'idents')
+
+    def __init__(self, newest):
+        self.newest = newest
+        self.order = collections.deque()
+        self.idents = set()
+
+    def add(self, ident, size):
+        self.order.append(ident)
+        self.idents.add(ident)
+        if len(self.order) > size:
+            self.idents.discard(self.order.popleft())
+
+
+class Deduplicator:
+    """
+    Tells which datagrams and observation rows were already seen or are
+    too old, per device (serial_number) and message type.
+
+    Before decoding, check() looks at the raw bytes. A datagram repeated
+    byte for byte is a duplicate. Events and status messages carry one
+    timestamp, and are stale when it is more than window seconds older
+    than the newest one; events can share a timestamp, so they are told
+    apart by a checksum of the whole datagram as well.
+
+    Observation packets can hold several rows, so after decoding
+    checkRow() judges every row by its own timestamp: a row whose
+    timestamp is among the last size seen is a duplicate, one more than
+    window seconds older than the newest is stale. Late rows within the
+    window are let through, so rain that arrives out of order is still
+    counted once.
+
+    A timestamp more than skew seconds ahead of the local clock, e.g.
+    from a hub whose clock is wrong after a reset, is 'future' and never
+    becomes the newest, so it cannot make the later rows stale.
+    Datagrams without a type, serial_number or timestamp are let through
+    for the decoder to judge.
+    """
+    def __init__(self, window=DEDUP_WINDOW, size=64, skew=MAX_CLOCK_SKEW):
+        self.window = window
+        self.size = size
+        self.skew = skew
+        # (serial_number, type): _Seen of timestamps, or of checksums
+        self._seen = {}
+        self._datagrams = {}
+
+    def check(self, data):
+        """ Returns None for a new datagram, otherwise 'duplicate', 'stale' or 'future'. """
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode('utf-8')
+        msg_type = peekType(data)
+        serial_number = peekSerial(data)
+        if msg_type is None or serial_number is None:
+            return None
+        key = (serial_number, msg_type)
+        if msg_type in OBSERVATION_TYPES:
+            # the rows are judged one by one once decoded
+            ident = zlib.crc32(data)
+            seen = self._datagrams.get(key)
+            if seen is None:
+                seen = self._datagrams[key] = _Seen(None)
+            if ident in seen.idents:
+                return 'duplicate'
+            seen.add(ident, self.size)
+            return None
+        timestamp = peekTimestamp(data)
+        if timestamp is None:
+            return None
+        return self._judge(key, timestamp, (timestamp, zlib.crc32(data)))
+
+    def checkRow(self, serial_number, msg_type, timestamp):
+        """ Returns None for a new observation row, otherwise 'duplicate', 'stale' or 'future'. """
+        if serial_number is None or timestamp is None:
+            return None
+        return self._judge((serial_number, msg_type), timestamp, timestamp)
+
+    def _judge(self, key, timestamp, ident):
+        if timestamp > time.time() + self.skew:
+            return 'future'
+        seen = self._seen.get(key)
+        if seen is None:
+            seen = self._seen[key] = _Seen(timestamp)
+        if ident in seen.idents:
+            return 'duplicate'
+        if timestamp <= seen.newest - self.window:
+            return 'stale'
+        seen.add(ident, self.size)
+        if timestamp > seen.newest:
+            seen.newest = timestamp
+        return None
+
+    def reset(self):
+        """ Forget everything seen, e.g. before replaying a capture again. """
+        self._seen.clear()
+        self._datagrams.clear()
@@ -0,0 +1,110 @@
+""" Queued callback delivery, so slow consumers do not stall reception. """
+import collections
+import threading
+import time
+
+from .constants import (
+    DROP_OLDEST,
+    DROP_NEWEST,
+    BLOCK
+)
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class QueuedCallback:
+    """
+    Wraps a callback with a bounded queue and a worker thread. Calling it
+    only enqueues the dataset; the worker delivers them in order.
+
+    When the queue is full the overflow policy decides what happens:
+    drop_oldest discards the oldest queued dataset, drop_newest discards
+    the new one and block waits for room (and so stalls the caller).
+    """
+    def __init__(self, callback, maxsize=100, overflow=DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        self.callback = callback
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        # Counters
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, ds):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._queue) >= self.maxsize:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+            self._queue.append((time.time(), ds))
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stats(self):
+        """ Returns the counters as a dictionary. """
+        delivered = self.delivered or 1
+        return {
+            'queued': len(self._queue),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'latency_avg': self.latency_total / delivered,
+            'latency_max': self.latency_max,
+            'duration_avg': self.duration_total / delivered,
+            'duration_max': self.duration_max,
+        }
+
+    def close(self, timeout=None):
+        """ Deliver what is queued, then stop the worker. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                queued, ds = self._queue.popleft()
+                self._cond.notify_all()
+            start = time.time()
+            try:
+                self.callback(ds)
+            except Exception:
+                self.errors += 1
+            end = time.time()
+            latency = end - queued
+            duration = end - start
+            self.delivered += 1
+            self.latency_total += latency
+            self.duration_total += duration
+            if latency > self.latency_max:
+                self.latency_max = latency
+            if duration > self.duration_max:
+                self.duration_max = duration
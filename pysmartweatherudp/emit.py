@@ -0,0 +1,143 @@
+""" Change detection and rate limiting in front of a callback. """
+import threading
+import time
+
+from . import utils
+
+
+class _Station(object):
+    """ What was passed on for a station, and the dataset held back. """
+    __slots__ = ('sent', 'values', 'pending', 'timer')
+
+    def __init__(self, sent, values):
+        self.sent = sent
+        self.values = values
+        self.pending = None
+        self.timer = None
+
+
+class ChangeFilter:
+    """
+    Wraps a callback so it only sees datasets that changed something.
+
+    For every station the values last passed on are remembered. A field
+    counts as changed when it differs from that value by more than its
+    deadband, or differs at all when it has none. Datasets without a
+    changed field are dropped. With interval, a station is passed on at
+    most once per interval seconds; the latest dataset in between is held
+    back and passed on when the interval ends, so the last update of a
+    burst is never lost. A dataset arriving after the interval replaces
+    the one held back. flush() passes on the held back datasets at once.
+
+    With deltas the callback is called as callback(ds, changes), changes
+    being a dictionary of the changed fields, otherwise as callback(ds).
+    The callback is called from the receiving thread, or from a timer
+    thread for a held back dataset, never from both at once.
+
+        receiver.registerCallback(ChangeFilter(publish, {'temperature': 0.2}, interval=10))
+    """
+    def __init__(self, callback, deadbands=None, interval=None, deltas=False,
+                 fields=utils.STATE_FIELDS):
+        self.callback = callback
+        self.deadbands = deadbands or {}
+        self.interval = interval
+        self.deltas = deltas
+        self.fields = fields
+        # hub_sn: _Station
+        self._stations = {}
+        self._lock = threading.RLock()
+        # Counters
+        self.emitted = 0
+        self.unchanged = 0
+        self.coalesced = 0
+
+    def __call__(self, ds):
+        with self._lock:
+            now = time.time()
+            last = self._stations.get(ds.hub_sn)
+            if last is None:
+                changes = dict((name, getattr(ds, name, None)) for name in self.fields)
+                self._stations[ds.hub_sn] = _Station(now, dict(changes))
+                self._emit(ds, changes)
+                return
+            if self.interval and now - last.sent < self.interval:
+                # hold it back until the interval ends, replacing an older one
+                self.coalesced += 1
+                last.pending = ds
+                if last.timer is None:
+                    last.timer = threading.Timer(last.sent + self.interval - now,
+                                                 self._expire, (ds.hub_sn, last))
+                    last.timer.daemon = True
+                    last.timer.start()
+                return
+            self._cancel(last)
+            self._send(last, ds, now)
+
+    def _expire(self, station, last):
+        with self._lock:
+            if self._stations.get(station) is not last or last.timer is None:
+                # reset, flushed or superseded meanwhile
+                return
+            last.timer = None
+            ds, last.pending = last.pending, None
+            if ds is not None:
+                self._send(last, ds, time.time())
+
+    def _send(self, last, ds, now):
+        changes = self._changes(ds, last.values)
+        if not changes:
+            self.unchanged += 1
+            return
+        last.sent = now
+        last.values.update(changes)
+        self._emit(ds, changes)
+
+    def _emit(self, ds, changes):
+        self.emitted += 1
+        if self.deltas:
+            self.callback(ds, changes)
+        else:
+            self.callback(ds)
+
+    def _changes(self, ds, values):
+        changes = {}
+        deadbands = self.deadbands
+        for name in self.fields:
+            new = getattr(ds, name, None)
+            old = values.get(name)
+            band = deadbands.get(name)
+            if band is not None and new is not None and old is not None:
+                if abs(new - old) <= band:
+                    continue
+            elif new == old:
+                continue
+            changes[name] = new
+        return changes
+
+    @staticmethod
+    def _cancel(last):
+        if last.timer is not None:
+            last.timer.cancel()
+            last.timer = None
+        last.pending = None
+
+    def flush(self):
+        """ Pass on the datasets held back by interval now, e.g. on shutdown. """
+        with self._lock:
+            for last in self._stations.values():
+                ds = last.pending
+                self._cancel(last)
+                if ds is not None:
+                    self._send(last, ds, time.time())
+
+    def reset(self, station=None):
+        """ Forget what was passed on and held back, for one hub_sn or all stations. """
+        with self._lock:
+            if station is None:
+                for last in self._stations.values():
+                    self._cancel(last)
+                self._stations.clear()
+            else:
+                last = self._stations.pop(station, None)
+                if last is not None:
+                    self._cancel(last)
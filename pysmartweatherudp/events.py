@@ -0,0 +1,73 @@
+""" Event and status messages broadcast by the hub. """
+from . import utils
+
+
+class StrikeEvent(utils.UnitViews):
+    """ A single lightning strike (evt_strike). """
+    __slots__ = ('type', 'timestamp', 'serial_number', 'hub_sn', 'distance', 'energy', '_views')
+    unit_fields = (('distance', 'distance'),)
+
+    def __init__(self, data, units):
+        conv = utils.getConverters(units)
+        self.type = 'strike'
+        self.timestamp = data[0]
+        self.distance = conv.distance(data[1])
+        self.energy = data[2]
+        self._views = None
+
+    def copy(self):
+        """ Returns a copy of the event. """
+        event = StrikeEvent.__new__(StrikeEvent)
+        utils.copyFields(event, self, self.__slots__)
+        event._views = None
+        return event
+
+
+class PrecipEvent(utils.UnitViews):
+    """ Rain has started (evt_precip). """
+    __slots__ = ('type', 'timestamp', 'serial_number', 'hub_sn')
+
+    def __init__(self, data, units):
+        self.type = 'precip'
+        self.timestamp = data[0]
+
+
+class DeviceStatus(utils.UnitViews):
+    """ Health of an AIR, SKY or Tempest unit (device_status). """
+    __slots__ = ('type', 'timestamp', 'serial_number', 'hub_sn', 'uptime', 'voltage',
+                 'firmware_revision', 'rssi', 'hub_rssi', 'sensor_status', 'debug')
+
+    def __init__(self, data, units):
+        self.type = 'device_status'
+        self.timestamp = data.get('timestamp')
+        self.uptime = data.get('uptime')
+        self.voltage = data.get('voltage')
+        self.firmware_revision = data.get('firmware_revision')
+        self.rssi = data.get('rssi')
+        self.hub_rssi = data.get('hub_rssi')
+        self.sensor_status = data.get('sensor_status')
+        self.debug = data.get('debug')
+
+
+class HubStatus(utils.UnitViews):
+    """ Health of the hub itself (hub_status). """
+    __slots__ = ('type', 'timestamp', 'serial_number', 'hub_sn', 'uptime', 'rssi',
+                 'firmware_revision', 'reset_flags', 'seq')
+
+    def __init__(self, data, units):
+        self.type = 'hub_status'
+        self.timestamp = data.get('timestamp')
+        self.uptime = data.get('uptime')
+        self.rssi = data.get('rssi')
+        self.firmware_revision = data.get('firmware_revision')
+        self.reset_flags = data.get('reset_flags')
+        self.seq = data.get('seq')
+
+
+EVENT_TYPES = {
+    # type: (event class, json key or None for the whole message)
+    'evt_strike': (StrikeEvent, 'evt'),
+    'evt_precip': (PrecipEvent, 'evt'),
+    'device_status': (DeviceStatus, None),
+    'hub_status': (HubStatus, None),
+}
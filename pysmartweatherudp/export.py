@@ -0,0 +1,224 @@
+""" Batched export of the datasets to daily CSV, JSON lines or Parquet files. """
+import collections
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import threading
+
+from . import utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# Columns written by default
+EXPORT_FIELDS = ('type', 'timestamp', 'serial_number', 'hub_sn') + utils.STATE_FIELDS
+# Columns holding text, the others are numbers
+_TEXT_FIELDS = ('type', 'serial_number', 'hub_sn', 'lightning_time', 'wind_direction')
+
+if str is bytes:
+    # Python 2, the csv module writes bytes
+    _CsvBuffer = io.BytesIO
+
+    def _openCsv(filename):
+        return open(filename, 'ab')
+else:
+    _CsvBuffer = io.StringIO
+
+    def _openCsv(filename):
+        return open(filename, 'a', newline='')
+
+
+class Sink(object):
+    """
+    Collects datasets in memory and writes them in bulk from a background
+    thread, when batch_size rows are waiting or every interval seconds.
+    Rows go to one file per local day of their timestamp, named
+    prefix-YYYY-MM-DD with the extension of the format, in directory.
+
+    Register it like any callback; calling it only appends a row, so the
+    receiving thread never waits for the disk. When the writer falls
+    behind by more than max_rows rows the oldest are dropped. Call close()
+    to write what is left.
+
+    Sink itself writes nothing; use CsvSink, JsonlSink or ParquetSink, or
+    a subclass that sets extension and implements write().
+    """
+    extension = None
+
+    def __init__(self, directory, prefix='weather', fields=EXPORT_FIELDS, batch_size=1000,
+                 interval=10, max_rows=100000):
+        cls = self.__class__
+        # unbound methods on Python 2, functions on Python 3
+        write = getattr(cls.write, '__func__', cls.write)
+        if cls.extension is None or write is getattr(Sink.write, '__func__', Sink.write):
+            raise TypeError('%s is abstract, use CsvSink, JsonlSink or ParquetSink'
+                            % cls.__name__)
+        self.directory = directory
+        self.prefix = prefix
+        self.fields = tuple(fields)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_rows = max_rows
+        self._rows = collections.deque(maxlen=max_rows)
+        self._cond = threading.Condition()
+        self._closed = False
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.errors = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, ds):
+        row = tuple(getattr(ds, name, None) for name in self.fields)
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._rows) == self.max_rows:
+                # the oldest row makes room
+                self.dropped += 1
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+
+    def filename(self, day):
+        """ Returns the path of the file for a day, a YYYY-MM-DD string. """
+        return os.path.join(self.directory, '%s-%s.%s' % (self.prefix, day, self.extension))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._rows) < self.batch_size and not self._closed:
+                    self._cond.wait(self.interval)
+                rows, self._rows = self._rows, collections.deque(maxlen=self.max_rows)
+                closed = self._closed
+            if rows:
+                self._flush(rows)
+            if closed:
+                return
+
+    def _flush(self, rows):
+        """ Write rows grouped by day, each group in one write. """
+        index = self.fields.index('timestamp') if 'timestamp' in self.fields else None
+        days = {}
+        for row in rows:
+            timestamp = row[index] if index is not None else None
+            day = datetime.date.fromtimestamp(timestamp) if timestamp else datetime.date.today()
+            days.setdefault(day.isoformat(), []).append(row)
+        for day, day_rows in sorted(days.items()):
+            try:
+                self.write(day, day_rows)
+                self.written += len(day_rows)
+            except Exception:
+                # a failing write must not stop the writer thread
+                self.errors += 1
+                _LOGGER.exception("Could not write %d rows to %s", len(day_rows), self.filename(day))
+        self.flushes += 1
+
+    def write(self, day, rows):
+        """ Append rows to the file of a day, implemented by the subclasses. """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Wake the writer to write the waiting rows now. """
+        with self._cond:
+            self._cond.notify()
+
+    def close(self, timeout=None):
+        """ Write the waiting rows and stop the writer. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+
+class CsvSink(Sink):
+    """ Daily CSV files with a header line. """
+    extension = 'csv'
+
+    def write(self, day, rows):
+        filename = self.filename(day)
+        buffer = _CsvBuffer()
+        writer = csv.writer(buffer)
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            writer.writerow(self.fields)
+        writer.writerows(rows)
+        with _openCsv(filename) as export:
+            export.write(buffer.getvalue())
+
+
+class JsonlSink(Sink):
+    """ Daily JSON lines files, an object per dataset. """
+    extension = 'jsonl'
+
+    def write(self, day, rows):
+        fields = self.fields
+        lines = [json.dumps(dict(zip(fields, row)), default=str) for row in rows]
+        with open(self.filename(day), 'a') as export:
+            export.write('\n'.join(lines) + '\n')
+
+
+class ParquetSink(Sink):
+    """
+    Daily Parquet files, each flush adds a row group. Needs pyarrow.
+    A Parquet file is only readable once it is closed, which happens when
+    the day changes and on close(); a file left from an earlier run is
+    not appended to, the next part number is used.
+    """
+    extension = 'parquet'
+
+    def __init__(self, directory, prefix='weather', fields=EXPORT_FIELDS, batch_size=1000,
+                 interval=10, max_rows=100000):
+        if pyarrow is None:
+            raise RuntimeError('ParquetSink needs pyarrow')
+        self.schema = pyarrow.schema([
+            (name, pyarrow.string() if name in _TEXT_FIELDS else pyarrow.float64())
+            for name in fields])
+        self._day = None
+        self._writer = None
+        Sink.__init__(self, directory, prefix, fields, batch_size, interval, max_rows)
+
+    def _open(self, day):
+        filename = self.filename(day)
+        part = 0
+        while os.path.exists(filename):
+            part += 1
+            filename = os.path.join(self.directory, '%s-%s.%d.%s' % (self.prefix, day, part, self.extension))
+        self._writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self._day = day
+
+    def write(self, day, rows):
+        if day != self._day:
+            self._closeWriter()
+            self._open(day)
+        columns = list(zip(*rows))
+        arrays = []
+        for name, column in zip(self.fields, columns):
+            if name in _TEXT_FIELDS:
+                values = [None if value is None else str(value) for value in column]
+            else:
+                values = [None if value is None else float(value) for value in column]
+            arrays.append(pyarrow.array(values, type=self.schema.field(name).type))
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def _closeWriter(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._day = None
+
+    def close(self, timeout=None):
+        Sink.close(self, timeout)
+        self._closeWriter()
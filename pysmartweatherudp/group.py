@@ -0,0 +1,265 @@
+""" Receive Smart Weather packets with several worker processes. """
+import errno
+import functools
+import multiprocessing
+import select
+import socket
+import sys
+import threading
+import zlib
+from multiprocessing.connection import wait
+
+from .decoder import peekStation
+from .pipeline import Pipeline
+from .receiver import createSocket
+
+from .constants import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    DEFAULT_UNITS,
+    DEDUP_WINDOW,
+    DEFAULT_BATCH_SIZE,
+    MAX_DATAGRAM_SIZE,
+    DROP_OLDEST,
+    RAW_UNITS
+)
+
+
+# Room for the ancillary data of IP_PKTINFO and IPV6_PKTINFO
+_PKTINFO_SIZE = socket.CMSG_SPACE(20) if hasattr(socket, 'CMSG_SPACE') else 0
+# Only exported by the socket module from Python 3.12 on
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8 if sys.platform.startswith('linux') else None)
+
+
+def _askDestination(sock):
+    """
+    Ask for the destination address of every datagram. Returns False
+    when the platform cannot report it.
+    """
+    try:
+        if sock.family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+        else:
+            if IP_PKTINFO is None:
+                return False
+            sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+    except (AttributeError, OSError):
+        return False
+    return _PKTINFO_SIZE > 0 and hasattr(sock, 'recvmsg_into')
+
+
+def _isUnicast(ancdata):
+    """
+    Tells from the packet info of a datagram whether it was sent to this
+    host alone. A broadcast or multicast datagram reaches every worker.
+    """
+    for level, kind, data in ancdata:
+        if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+            # the header destination is the local address only for unicast
+            return data[4:8] == data[8:12]
+        if level == socket.IPPROTO_IPV6 and kind == socket.IPV6_PKTINFO:
+            return data[0:1] != b'\xff'
+    return True
+
+
+def shardOf(station, shards):
+    """ Returns the worker index for a station, stable across processes. """
+    if station is None:
+        return 0
+    return zlib.crc32(station.encode('utf-8')) % shards
+
+
+def _worker(conn, shard, shards, inboxes, host, port, units, types, rcvbuf, wind_windows,
+            batch_size, backend, dedup_window, keep_state):
+    """ Worker process: decode and merge the stations of one shard. """
+    sock = createSocket(host, port, rcvbuf, reuse_port=True)
+    inbox = inboxes[shard][0]
+    pktinfo = shards > 1 and _askDestination(sock)
+    pipeline = Pipeline(units, wind_windows=wind_windows, backend=backend,
+                        dedup_window=dedup_window, keep_state=keep_state)
+    out = []
+    # datasets are sent raw, with the station snapshot they were merged
+    # with, and converted for each callback by the parent
+    for msg_type in types:
+        pipeline.registerCallback(
+            functools.partial(lambda t, ds: out.append((t, ds, getattr(ds, '_state', None))), msg_type),
+            types=[msg_type], units=RAW_UNITS)
+    counts = {'forwarded': 0, 'forward_dropped': 0}
+    buf = bytearray(MAX_DATAGRAM_SIZE)
+    view = memoryview(buf)
+    try:
+        while True:
+            rdlist, _, _ = select.select([sock, inbox, conn], [], [])
+            if conn in rdlist:
+                # the parent only ever asks us to stop
+                break
+            if inbox in rdlist:
+                # datagrams of our stations that another worker read
+                for _ in range(batch_size):
+                    try:
+                        nbytes = inbox.recv_into(buf)
+                    except socket.error as err:
+                        if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            break
+                        raise
+                    pipeline.handle(view[:nbytes].tobytes())
+            for _ in range(batch_size if sock in rdlist else 0):
+                try:
+                    if pktinfo:
+                        nbytes, ancdata, _, _ = sock.recvmsg_into([buf], _PKTINFO_SIZE)
+                    else:
+                        nbytes = sock.recv_into(buf)
+                except socket.error as err:
+                    if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                data = view[:nbytes].tobytes()
+                if shards > 1:
+                    owner = shardOf(peekStation(data), shards)
+                    if owner != shard:
+                        # the owner got its own copy of a broadcast, but
+                        # the kernel gives a unicast datagram to one socket
+                        if not pktinfo or _isUnicast(ancdata):
+                            try:
+                                inboxes[owner][1].send(data)
+                                counts['forwarded'] += 1
+                            except socket.error:
+                                counts['forward_dropped'] += 1
+                        continue
+                pipeline.handle(data)
+            if out or counts['forwarded'] or counts['forward_dropped']:
+                conn.send((out, counts))
+                out = []
+                counts = {'forwarded': 0, 'forward_dropped': 0}
+    finally:
+        sock.close()
+        conn.close()
+
+
+class ReceiverGroup:
+    """
+    Listen with several worker processes, each with its own SO_REUSEPORT
+    socket on the same address. Each worker decodes only the stations
+    (hubs) of its shard and sends the merged datasets to this process
+    over a pipe, where the registered callbacks are called from a
+    collector thread. A station is always handled by the same worker, so
+    its state stays consistent.
+
+    WeatherFlow packets are broadcast, so every socket gets a copy and a
+    worker skips the stations of the others. A unicast datagram, from a
+    relay or a replay, only reaches one socket; when it belongs to
+    another shard it is forwarded to the owner over a Unix socket. The
+    destination address of each datagram (IP_PKTINFO) tells them apart;
+    where the platform cannot report it every datagram is forwarded, and
+    the owner drops the copies as duplicates. forwarded and
+    forward_dropped count the datagrams passed on and lost because the
+    owner fell behind.
+
+    With shard set to False each worker handles whatever it reads, and a
+    station can end up split over several workers. Callbacks must be
+    registered before start().
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, units=DEFAULT_UNITS,
+                 workers=None, rcvbuf=None, wind_windows=None, batch_size=DEFAULT_BATCH_SIZE,
+                 shard=True, backend=None, dedup_window=DEDUP_WINDOW, keep_state=True):
+        self.host = host
+        self.port = port
+        self.units = units
+        self.workers = workers or multiprocessing.cpu_count()
+        self.rcvbuf = rcvbuf
+        self.wind_windows = wind_windows
+        self.batch_size = batch_size
+        self.shard = shard
+        self.backend = backend
+        self.dedup_window = dedup_window
+        self.keep_state = keep_state
+        # only used to register and dispatch callbacks
+        self._pipeline = Pipeline(units, keep_state=keep_state)
+        self._processes = []
+        self._connections = []
+        self._inboxes = []
+        self._collector = None
+        self.datasets = 0
+        self.forwarded = 0
+        self.forward_dropped = 0
+
+    def registerCallback(self, callback, station=None, queue_size=None, overflow=DROP_OLDEST,
+                         types=None, units=None):
+        """ Register a callback, see SWReceiver.registerCallback. """
+        if self._processes:
+            raise RuntimeError('Callbacks must be registered before start()')
+        return self._pipeline.registerCallback(callback, station, queue_size, overflow, types,
+                                               units)
+
+    def snapshot(self, station, units=None):
+        """ Returns the latest state of a station, see SWReceiver.snapshot. """
+        return self._pipeline.snapshot(station, units)
+
+    def start(self):
+        """ Start the worker processes and the collector thread. """
+        types = sorted(self._pipeline._wanted)
+        shards = self.workers if self.shard else 1
+        # (read end, write end) of the datagrams forwarded to each worker
+        self._inboxes = []
+        for _ in range(self.workers):
+            inbox = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for end in inbox:
+                end.setblocking(False)
+            self._inboxes.append(inbox)
+        for shard in range(self.workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_worker,
+                args=(child, shard, shards, self._inboxes, self.host, self.port, self.units,
+                      types, self.rcvbuf, self.wind_windows, self.batch_size, self.backend,
+                      self.dedup_window, self.keep_state))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._processes.append(process)
+            self._connections.append(parent)
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _collect(self):
+        connections = list(self._connections)
+        while connections:
+            for conn in wait(connections):
+                try:
+                    batch = conn.recv()
+                except (EOFError, OSError):
+                    connections.remove(conn)
+                    continue
+                batch, counts = batch
+                self.forwarded += counts['forwarded']
+                self.forward_dropped += counts['forward_dropped']
+                for msg_type, ds, snapshot in batch:
+                    self.datasets += 1
+                    if snapshot is not None:
+                        state = self._pipeline.stations.lookup(ds.hub_sn, ds.serial_number)
+                        # late datasets come with the snapshot already published
+                        if state.latest is None or snapshot.version > state.latest.version:
+                            state.latest = snapshot
+                    self._pipeline.dispatch(msg_type, ds)
+
+    def stop(self, timeout=None):
+        """ Stop the workers and wait for the last datasets. """
+        for conn in self._connections:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            process.join(timeout)
+        if self._collector is not None:
+            self._collector.join(timeout)
+        for conn in self._connections:
+            conn.close()
+        for inbox in self._inboxes:
+            for end in inbox:
+                end.close()
+        self._inboxes = []
+        self._pipeline.close()
+        self._processes = []
+        self._connections = []
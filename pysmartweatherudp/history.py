@@ -0,0 +1,415 @@
+""" Per-station history of the observations, with time range queries. """
+import array
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+
+from . import utils
+from .metrics import numpy
+
+_replace = getattr(os, 'replace', os.rename)
+
+MAGIC = b'SWHIST1\n'
+CHUNK_SUFFIX = '.swh'
+_HEADER_SIZE = struct.Struct('<I')
+_NAN = float('nan')
+# hub_sn values used as directory names, e.g. HB-00000001
+_STATION_NAME = re.compile(r'[A-Za-z0-9_-]+\Z')
+
+
+def _recorded(*groups):
+    """ Returns (column, attribute) pairs of the numeric fields in groups. """
+    names = []
+    for group in groups:
+        names.extend(name for name in group
+                     if name not in ('lightning_time', 'wind_direction', 'precipitation_rate'))
+    return tuple((name, name) for name in names)
+
+
+def _validStation(station):
+    """ Tells if a hub_sn is safe to use as a directory name. """
+    try:
+        return _STATION_NAME.match(station) is not None
+    except TypeError:
+        return False
+
+# Columns recorded for each dataset type. Only what the device measured is
+# recorded, the other fields are copies of the station state. rain is the
+# amount of the reporting interval, which the datasets carry as
+# precipitation_rate.
+HISTORY_FIELDS = {
+    'rapid_wind': _recorded(utils.RAPID_WIND_FIELDS),
+    'air': _recorded(utils.AIR_FIELDS, utils.CALCULATED_FIELDS),
+    'sky': _recorded(utils.SKY_FIELDS) + (('rain', 'precipitation_rate'),),
+    'st': _recorded(utils.AIR_FIELDS, utils.SKY_FIELDS, utils.CALCULATED_FIELDS) +
+          (('rain', 'precipitation_rate'),),
+}
+
+
+def _reducers():
+    if numpy is None:
+        return {
+            'min': min,
+            'max': max,
+            'sum': sum,
+            'count': len,
+            'mean': lambda v: sum(v) / len(v),
+            'first': lambda v: v[0],
+            'last': lambda v: v[-1],
+        }
+    return {
+        'min': numpy.min,
+        'max': numpy.max,
+        'sum': numpy.sum,
+        'count': len,
+        'mean': numpy.mean,
+        'first': lambda v: v[0],
+        'last': lambda v: v[-1],
+    }
+
+# Aggregations of aggregate() and resample()
+AGGREGATES = _reducers()
+
+
+class _Chunk(object):
+    """
+    The values of one station within [start, end). Every field has a
+    timestamp column and a value column, sorted by time. A live chunk
+    keeps them in arrays; a sealed chunk on disk is memory-mapped.
+    """
+    __slots__ = ('start', 'end', 'fields', 'live', 'filename', '_mmap', '_views')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        # name: (timestamps, values)
+        self.fields = {}
+        self.live = True
+        self.filename = None
+        self._mmap = None
+        self._views = []
+
+    def add(self, timestamp, values):
+        """ Add the (name, value) pairs of one dataset. """
+        for name, value in values:
+            series = self.fields.get(name)
+            if series is None:
+                series = self.fields[name] = (array.array('d'), array.array('d'))
+            times, column = series
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = _NAN
+            if not times or timestamp >= times[-1]:
+                times.append(timestamp)
+                column.append(value)
+            else:
+                # a datagram that arrived late
+                index = bisect.bisect_right(times, timestamp)
+                times.insert(index, timestamp)
+                column.insert(index, value)
+
+    def write(self, filename):
+        """ Write the chunk to filename, replacing it atomically. """
+        offsets = {}
+        offset = 0
+        for name, (times, _) in sorted(self.fields.items()):
+            offsets[name] = [offset, len(times)]
+            offset += 16 * len(times)
+        header = json.dumps({
+            'start': self.start,
+            'end': self.end,
+            'byteorder': sys.byteorder,
+            'fields': offsets,
+        }).encode('utf-8')
+        # the columns start on an 8 byte boundary
+        header += b' ' * (-(len(MAGIC) + _HEADER_SIZE.size + len(header)) % 8)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as chunk:
+            chunk.write(MAGIC)
+            chunk.write(_HEADER_SIZE.pack(len(header)))
+            chunk.write(header)
+            for name, (times, column) in sorted(self.fields.items()):
+                chunk.write(times.tobytes())
+                chunk.write(column.tobytes())
+        _replace(tmp, filename)
+        self.filename = filename
+
+    @classmethod
+    def load(cls, filename):
+        """ Map a chunk file. Returns None when it is not a chunk. """
+        with open(filename, 'rb') as chunk:
+            if chunk.read(len(MAGIC)) != MAGIC:
+                return None
+            size, = _HEADER_SIZE.unpack(chunk.read(_HEADER_SIZE.size))
+            header = json.loads(chunk.read(size).decode('utf-8'))
+            mapped = mmap.mmap(chunk.fileno(), 0, access=mmap.ACCESS_READ)
+        self = cls(header['start'], header['end'])
+        self.live = False
+        self.filename = filename
+        self._mmap = mapped
+        base = len(MAGIC) + _HEADER_SIZE.size + size
+        swap = header['byteorder'] != sys.byteorder
+        view = memoryview(mapped)
+        self._views.append(view)
+        for name, (offset, count) in header['fields'].items():
+            start = base + offset
+            middle = start + 8 * count
+            series = view[start:middle].cast('d'), view[middle:middle + 8 * count].cast('d')
+            if swap:
+                series = tuple(array.array('d', s) for s in series)
+                for s in series:
+                    s.byteswap()
+            else:
+                self._views.extend(series)
+            self.fields[name] = series
+        return self
+
+    def reopen(self):
+        """ Copy a mapped chunk back into arrays to add to it. """
+        self.fields = dict((name, (array.array('d', times), array.array('d', column)))
+                           for name, (times, column) in self.fields.items())
+        self.release()
+        self.live = True
+
+    def release(self):
+        """ Unmap the file. """
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class History:
+    """
+    Keeps the recorded fields of every observation per station (hub_sn)
+    and answers time range queries. Register it as a callback:
+
+        history = History('/var/lib/weather')
+        receiver.registerCallback(history, queue_size=1000)
+        history.aggregate(hub_sn, 'wind_gust', time.time() - 86400, how='max')
+
+    Values are kept per field as timestamp and value columns, in chunks of
+    chunk_seconds. Queries find the chunks and the rows with binary
+    searches on the timestamps, so their cost depends on the range asked
+    for and not on how much history there is. With a path, a chunk is
+    written to disk when the next one starts and is then memory-mapped;
+    the chunks found there are loaded at startup. Without one, the history
+    is kept in memory. Chunks older than retention seconds, counted from
+    the newest packet, are dropped.
+
+    Values are in the units of the receiver. Time is taken from the
+    packets, so replayed captures fill the history as it happened.
+    Datasets whose hub_sn is not made of letters, digits, '-' and '_'
+    are not recorded (counted in rejected), as it names their directory.
+    """
+    def __init__(self, path=None, chunk_seconds=3600, retention=7 * 86400):
+        self.path = path
+        self.chunk_seconds = chunk_seconds
+        self.retention = retention
+        self._lock = threading.Lock()
+        # hub_sn: chunks sorted by start, only the last one can be live
+        self._chunks = {}
+        # hub_sn: start of every chunk, for the binary search
+        self._starts = {}
+        self.newest = 0
+        # Counters
+        self.recorded = 0
+        self.late = 0
+        self.rejected = 0
+        if path is not None:
+            self._load()
+
+    def __call__(self, ds):
+        self.add(ds)
+
+    def add(self, ds):
+        """ Record the measured fields of a dataset. """
+        fields = HISTORY_FIELDS.get(ds.type)
+        if fields is None:
+            return
+        if not _validStation(ds.hub_sn):
+            # it comes from the network and names a directory
+            self.rejected += 1
+            return
+        timestamp = ds.timestamp
+        start = timestamp - timestamp % self.chunk_seconds
+        values = [(column, getattr(ds, name, None)) for column, name in fields]
+        with self._lock:
+            chunks = self._chunks.setdefault(ds.hub_sn, [])
+            chunk = chunks[-1] if chunks else None
+            if chunk is None or start > chunk.start:
+                if chunk is not None and chunk.live:
+                    self._seal(ds.hub_sn, chunk)
+                chunk = _Chunk(start, start + self.chunk_seconds)
+                chunks.append(chunk)
+                self._starts.setdefault(ds.hub_sn, []).append(start)
+            elif start < chunk.start:
+                # older chunks are sealed
+                self.late += 1
+                return
+            elif not chunk.live:
+                chunk.reopen()
+            chunk.add(timestamp, values)
+            self.recorded += 1
+            if timestamp > self.newest:
+                self.newest = timestamp
+                self._evict()
+
+    def _filename(self, station, start):
+        return os.path.join(self.path, station, '%d%s' % (start, CHUNK_SUFFIX))
+
+    def _seal(self, station, chunk):
+        chunk.live = False
+        if self.path is None:
+            return
+        directory = os.path.join(self.path, station)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = self._filename(station, chunk.start)
+        chunk.write(filename)
+        index = self._chunks[station].index(chunk)
+        self._chunks[station][index] = _Chunk.load(filename)
+
+    def _evict(self):
+        limit = self.newest - self.retention
+        for station, chunks in self._chunks.items():
+            starts = self._starts[station]
+            while chunks and chunks[0].end <= limit and not chunks[0].live:
+                chunk = chunks.pop(0)
+                starts.pop(0)
+                chunk.release()
+                if chunk.filename is not None:
+                    try:
+                        os.remove(chunk.filename)
+                    except OSError:
+                        pass
+
+    def _load(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            return
+        for station in os.listdir(self.path):
+            directory = os.path.join(self.path, station)
+            if not _validStation(station) or not os.path.isdir(directory):
+                continue
+            chunks = []
+            for name in os.listdir(directory):
+                if name.endswith(CHUNK_SUFFIX):
+                    try:
+                        chunk = _Chunk.load(os.path.join(directory, name))
+                    except (IOError, OSError, ValueError, KeyError):
+                        chunk = None
+                    if chunk is not None:
+                        chunks.append(chunk)
+            if chunks:
+                chunks.sort(key=lambda chunk: chunk.start)
+                self._chunks[station] = chunks
+                self._starts[station] = [chunk.start for chunk in chunks]
+                self.newest = max(self.newest, chunks[-1].end - 1)
+        self._evict()
+
+    def flush(self):
+        """ Write the live chunks to disk, they stay live. """
+        if self.path is None:
+            return
+        with self._lock:
+            for station, chunks in self._chunks.items():
+                if chunks and chunks[-1].live:
+                    directory = os.path.join(self.path, station)
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    chunks[-1].write(self._filename(station, chunks[-1].start))
+
+    def close(self):
+        """ Write the live chunks and unmap the files. """
+        self.flush()
+        with self._lock:
+            for chunks in self._chunks.values():
+                for chunk in chunks:
+                    chunk.release()
+            self._chunks = {}
+            self._starts = {}
+
+    def stations(self):
+        """ Returns the hub_sn of the stations with history. """
+        with self._lock:
+            return sorted(self._chunks)
+
+    def _ranges(self, station, field, start, end):
+        """ Yields (timestamps, values, i, j) for the rows in [start, end). """
+        chunks = self._chunks.get(station, ())
+        first = 0
+        if start is not None:
+            first = max(bisect.bisect_right(self._starts[station], start) - 1, 0)
+        for chunk in chunks[first:]:
+            if end is not None and chunk.start >= end:
+                break
+            series = chunk.fields.get(field)
+            if series is None:
+                continue
+            times, column = series
+            i = 0 if start is None else bisect.bisect_left(times, start)
+            j = len(times) if end is None else bisect.bisect_left(times, end)
+            if i < j:
+                yield times, column, i, j
+
+    def _values(self, station, field, start, end):
+        """ Returns the values in [start, end) without the missing ones. """
+        if numpy is None:
+            values = []
+            for _, column, i, j in self._ranges(station, field, start, end):
+                values.extend(value for value in column[i:j] if value == value)
+            return values
+        parts = [numpy.frombuffer(column[i:j], dtype=float)
+                 for _, column, i, j in self._ranges(station, field, start, end)]
+        if not parts:
+            return numpy.empty(0)
+        values = numpy.concatenate(parts)
+        return values[~numpy.isnan(values)]
+
+    def series(self, station, field, start=None, end=None):
+        """ Returns the (timestamp, value) pairs of a field in [start, end). """
+        with self._lock:
+            rows = []
+            for times, column, i, j in self._ranges(station, field, start, end):
+                rows.extend((t, v) for t, v in zip(times[i:j], column[i:j]) if v == v)
+            return rows
+
+    def aggregate(self, station, field, start=None, end=None, how='max'):
+        """
+        Returns min, max, sum, mean, count, first or last of a field in
+        [start, end), None when there are no values.
+        """
+        reduce = AGGREGATES[how]
+        with self._lock:
+            values = self._values(station, field, start, end)
+            if not len(values):
+                return 0 if how == 'count' else None
+            return float(reduce(values)) if how != 'count' else len(values)
+
+    def resample(self, station, field, start, end, interval=3600, how='sum'):
+        """
+        Aggregate a field over the intervals between start and end,
+        aligned to multiples of interval. Returns (interval start, value)
+        pairs for the intervals with values, e.g. hourly rain totals:
+
+            history.resample(hub_sn, 'rain', time.time() - 86400, time.time())
+        """
+        reduce = AGGREGATES[how]
+        buckets = []
+        with self._lock:
+            bucket = start - start % interval
+            while bucket < end:
+                values = self._values(station, field, max(bucket, start), min(bucket + interval, end))
+                if len(values):
+                    buckets.append((bucket, float(reduce(values)) if how != 'count' else len(values)))
+                bucket += interval
+        return buckets
@@ -0,0 +1,168 @@
+""" Derived weather metrics, memoized over their inputs. """
+import math
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2 has no lru_cache, the metrics are then computed every time
+    def lru_cache(maxsize=128):
+        return lambda function: function
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Results are cached on the exact inputs. They are not rounded first:
+# a Tempest reports temperature and humidity in hundredths, and the
+# formulas must see the values as sent. The state values repeat from one
+# packet to the next (wind chill runs on every rapid_wind with the same
+# temperature), which is what the cache catches.
+CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def dewPoint(temperature, humidity):
+    """ Returns Dew Point in Celcius """
+    a = (17.625 * temperature) / (243.04 + temperature)
+    h = math.log(humidity / 100.0)
+    return round(243.04 * (h + a) / (17.625 - h - a), 1)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def windChill(wind_speed, temperature):
+    """ Returns Wind Chill in Celcius """
+    if wind_speed < 1.3:
+        return round(temperature, 1)
+    windKmh = wind_speed * 3.6
+    return round(13.12 + (0.6215 * temperature) - (11.37 * math.pow(windKmh, 0.16)) + (0.3965 * temperature * math.pow(windKmh, 0.16)), 1)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def heatIndex(temperature, humidity):
+    """ Returns Heat Index in Celcius """
+    T = temperature * 9/5 + 32 #Convert to Fahrenheit
+    RH = humidity
+    # try simplified formula first (used for HI < 80)
+    HI = 0.5 * (T + 61. + (T - 68.) * 1.2 + RH * 0.094)
+    if HI >= 80:
+        # use Rothfusz regression
+        HI = math.fsum([
+            -42.379,
+            2.04901523 * T,
+            10.14333127 * RH,
+            -0.22475541 * T * RH,
+            -6.83783e-3 * T**2,
+            -5.481717e-2 * RH**2,
+            1.22874e-3 * T**2 * RH,
+            8.5282e-4 * T * RH**2,
+            -1.99e-6 * T**2 * RH**2,
+        ])
+    # Return value in Celcius
+    return round((HI - 32) * 5/9, 1)
+
+
+def feelsLike(temperature, wind_chill, heat_index):
+    """ Returns the Feels Like Temperature in Celcius """
+    if temperature > 26.666666667:
+        return heat_index
+    elif temperature < 10:
+        return wind_chill
+    else:
+        return round(temperature,1)
+
+
+def wetBulb(temperature, humidity):
+    """ Returns the Wet Bulb Temperature in Celcius (Stull 2011) """
+    T = temperature
+    RH = humidity
+    return round(T * math.atan(0.151977 * math.sqrt(RH + 8.313659))
+                 + math.atan(T + RH) - math.atan(RH - 1.676331)
+                 + 0.00391838 * RH**1.5 * math.atan(0.023101 * RH) - 4.686035, 1)
+
+
+def seaLevelPressure(pressure, temperature, elevation):
+    """ Returns the station pressure in mb reduced to sea level, elevation in m """
+    return round(pressure * math.pow(1 - (0.0065 * elevation) / (temperature + 0.0065 * elevation + 273.15), -5.257), 1)
+
+
+def airDensity(pressure, temperature, humidity):
+    """ Returns the Air Density in kg/m3, pressure in mb """
+    kelvin = temperature + 273.15
+    vapour = 6.1078 * math.pow(10, 7.5 * temperature / (temperature + 237.3)) * humidity / 100.0
+    return round(((pressure - vapour) * 100) / (287.058 * kelvin) + (vapour * 100) / (461.495 * kelvin), 4)
+
+
+# Metrics ready to register: name: (function, input fields)
+EXTRA_METRICS = {
+    'wet_bulb': (wetBulb, ('temperature', 'humidity')),
+    'air_density': (airDensity, ('pressure', 'temperature', 'humidity')),
+}
+
+
+class MetricRegistry:
+    """
+    Additional metrics computed for every observation after it has been
+    merged with the station state. A metric is a function of dataset
+    fields; the results are in the metrics dictionary of the dataset.
+    The fields are in raw WeatherFlow units (C, mb, m/s, mm, km).
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def __len__(self):
+        return len(self._metrics)
+
+    def register(self, name, function=None, fields=None):
+        """ Add a metric, or one of EXTRA_METRICS by name alone. """
+        if function is None:
+            function, fields = EXTRA_METRICS[name]
+        self._metrics = [m for m in self._metrics if m[0] != name]
+        self._metrics.append((name, function, tuple(fields)))
+
+    def compute(self, ds):
+        """ Returns the metrics of a dataset by name. """
+        values = {}
+        for name, function, fields in self._metrics:
+            try:
+                values[name] = function(*[getattr(ds, field) for field in fields])
+            except (ValueError, TypeError, ZeroDivisionError):
+                values[name] = None
+        return values
+
+
+def dewPoints(temperature, humidity):
+    """ Returns the Dew Points in Celcius for arrays of values. """
+    if numpy is None:
+        return [dewPoint(t, h) for t, h in zip(temperature, humidity)]
+    t = numpy.asarray(temperature, dtype=float)
+    h = numpy.log(numpy.asarray(humidity, dtype=float) / 100)
+    a = (17.625 * t) / (243.04 + t)
+    return numpy.round(243.04 * (h + a) / (17.625 - h - a), 1).tolist()
+
+
+def heatIndices(temperature, humidity):
+    """ Returns the Heat Indices in Celcius for arrays of values. """
+    if numpy is None:
+        return [heatIndex(t, h) for t, h in zip(temperature, humidity)]
+    T = numpy.asarray(temperature, dtype=float) * 9 / 5 + 32
+    RH = numpy.asarray(humidity, dtype=float)
+    simple = 0.5 * (T + 61. + (T - 68.) * 1.2 + RH * 0.094)
+    # Rothfusz regression, used where the simple formula gives 80 or more
+    regression = (-42.379 + 2.04901523 * T + 10.14333127 * RH
+                  - 0.22475541 * T * RH - 6.83783e-3 * T**2 - 5.481717e-2 * RH**2
+                  + 1.22874e-3 * T**2 * RH + 8.5282e-4 * T * RH**2
+                  - 1.99e-6 * T**2 * RH**2)
+    HI = numpy.where(simple >= 80, regression, simple)
+    return numpy.round((HI - 32) * 5 / 9, 1).tolist()
+
+
+def windChills(wind_speed, temperature):
+    """ Returns the Wind Chills in Celcius for arrays of values. """
+    if numpy is None:
+        return [windChill(w, t) for w, t in zip(wind_speed, temperature)]
+    w = numpy.asarray(wind_speed, dtype=float)
+    t = numpy.asarray(temperature, dtype=float)
+    v = numpy.power(w * 3.6, 0.16)
+    chill = 13.12 + 0.6215 * t - 11.37 * v + 0.3965 * t * v
+    return numpy.round(numpy.where(w < 1.3, t, chill), 1).tolist()
@@ -0,0 +1,311 @@
+""" Decode, merge and dispatch stage shared by the receivers. """
+import logging
+import time
+
+from . import metrics, utils
+from .decoder import Decoder, MESSAGE_TYPES, OBSERVATION_TYPES
+from .dedup import Deduplicator
+from .dispatch import QueuedCallback
+from .rolling import RollingWindSet
+from .state import StationTable
+from .stats import ReceiverStats, callbackName, clock, errorCause
+
+from .constants import DEDUP_WINDOW, DROP_OLDEST, MAX_CLOCK_SKEW, RAW_UNITS
+from .utils import (
+    AIR_FIELDS,
+    SKY_MEASURED_FIELDS,
+    RAPID_WIND_FIELDS,
+    copyFields
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """
+    Turns raw datagrams into merged datasets and hands them to the
+    registered callbacks. It does no I/O, so any transport can feed it.
+    Datasets and station states are kept in raw WeatherFlow units; each
+    callback gets them in its own unit system, units by default.
+
+    Only the message types some callback asked for are decoded. With
+    keep_state, the default, and always with a store, observations are
+    decoded as well to keep the station states and snapshots current;
+    without it a pipeline that only serves events never parses them.
+    """
+    def __init__(self, units, store=None, wind_windows=None, backend=None,
+                 dedup_window=DEDUP_WINDOW, keep_state=True):
+        self.units = units
+        # Rolling rapid_wind window lengths in seconds, e.g. (60, 600)
+        self.wind_windows = tuple(wind_windows or ())
+        # Optional StateStore that checkpoints the station states
+        self.store = store
+        self._decoder = Decoder(RAW_UNITS, backend)
+        # Drops repeated and stale datagrams, None when disabled
+        self.dedup = Deduplicator(dedup_window) if dedup_window else None
+        # Callbacks by message type, and by message type and station
+        self._callbacks = {}
+        self._station_callbacks = {}
+        # Observations are decoded for the state even without callbacks
+        self.keep_state = keep_state or store is not None
+        self._wanted = set(OBSERVATION_TYPES) if self.keep_state else set()
+        self._queued = []
+        self._mergers = {
+            'rapid_wind': self._mergeRapidWind,
+            'obs_sky': self._mergeSky,
+            'obs_air': self._mergeAir,
+            'obs_st': self._mergeSt,
+        }
+        # Counters of the receive path
+        self.stats = ReceiverStats()
+        self.stats.queued = self._queued
+        # Additional metrics computed for every observation
+        self.metrics = metrics.MetricRegistry()
+        # Last read state per station
+        self.stations = StationTable()
+        if store is not None:
+            store.load(self.stations, RAW_UNITS)
+
+    def _mergeRapidWind(self, state, ds):
+        """ Merge a rapid_wind dataset into the station state. """
+        copyFields(state, ds, RAPID_WIND_FIELDS)
+        if self.wind_windows:
+            if state.wind_rolling is None:
+                state.wind_rolling = RollingWindSet(self.wind_windows)
+            state.wind_windows = state.wind_rolling.add(ds.timestamp, ds.wind_speed_rapid, ds.wind_bearing_rapid)
+            ds.wind_windows = state.wind_windows
+        self._calculate(state, ds)
+
+    def _mergeSky(self, state, ds):
+        """ Merge an obs_sky dataset into the station state. """
+        copyFields(state, ds, SKY_MEASURED_FIELDS)
+        state.accumulatePrecipitation(ds.timestamp, ds.precipitation_rate)
+        ds.precipitation = state.precipitation
+
+    def _mergeAir(self, state, ds):
+        """ Merge an obs_air dataset into the station state. """
+        copyFields(state, ds, AIR_FIELDS)
+        self._calculate(state, ds)
+
+    def _mergeSt(self, state, ds):
+        """ Merge an obs_st dataset into the station state. """
+        copyFields(state, ds, SKY_MEASURED_FIELDS)
+        state.accumulatePrecipitation(ds.timestamp, ds.precipitation_rate)
+        ds.precipitation = state.precipitation
+        copyFields(state, ds, AIR_FIELDS)
+        self._calculate(state, ds)
+
+    def _mergeLate(self, msg_type, state, ds):
+        """
+        Handle a dataset older than the newest merged one of its device
+        and type without changing the state; it reads the fields it does
+        not carry from the current snapshot. Only its rain is added to
+        the total. Returns True when that changed the total.
+        """
+        changed = False
+        if msg_type in ('obs_sky', 'obs_st'):
+            before = state.precipitation_raw
+            state.accumulatePrecipitation(ds.timestamp, ds.precipitation_rate)
+            ds.precipitation = state.precipitation
+            changed = state.precipitation_raw != before
+        if msg_type in ('obs_air', 'obs_st'):
+            ds.wind_chill = metrics.windChill(ds.wind_speed, ds.temperature)
+            ds.feels_like = metrics.feelsLike(ds.temperature, ds.wind_chill, ds.heat_index)
+        return changed
+
+    def _calculate(self, state, ds):
+        """ Update the values calculated from several sensors. """
+        state.wind_chill = metrics.windChill(state.wind_speed, state.temperature)
+        ds.wind_chill = state.wind_chill
+        state.feels_like = metrics.feelsLike(state.temperature, state.wind_chill, state.heat_index)
+        ds.feels_like = state.feels_like
+
+    def registerCallback(self, callback, station=None, queue_size=None, overflow=DROP_OLDEST,
+                         types=None, units=None):
+        """
+        Register a callback for every dataset, or only for the datasets
+        from one station, given by its hub_sn or a device serial_number.
+
+        types lists the message types to receive, by default the four
+        observation types. Event and status messages (evt_strike,
+        evt_precip, device_status, hub_status) are only decoded when a
+        callback asks for them, and so are observations without
+        keep_state.
+
+        Callbacks run inline unless queue_size is given, in which case they
+        get their own bounded queue and worker thread. Returns the
+        registered callable, a QueuedCallback holding the counters when
+        queued.
+
+        units is the unit system of the datasets the callback gets, the
+        one of the pipeline by default. Datasets are converted once per
+        unit system, and callbacks asking for raw units get them as is.
+        """
+        if types is None:
+            types = OBSERVATION_TYPES
+        for msg_type in types:
+            if msg_type not in MESSAGE_TYPES:
+                raise ValueError('Unknown message type: %s' % msg_type)
+        if queue_size is not None:
+            callback = QueuedCallback(callback, queue_size, overflow)
+            self._queued.append(callback)
+        # callbacks are kept with their converters and the histogram of their run time
+        conv = utils.getConverters(units or self.units)
+        entry = (callback, conv, self.stats.callbackHistogram(callback))
+        for msg_type in types:
+            if station is None:
+                self._callbacks.setdefault(msg_type, []).append(entry)
+            else:
+                stations = self._station_callbacks.setdefault(msg_type, {})
+                stations.setdefault(station, []).append(entry)
+        self._wanted.update(types)
+        return callback
+
+    def snapshot(self, station, units=None):
+        """
+        Returns the StationSnapshot of a hub_sn or serial_number in a unit
+        system, the one of the pipeline by default, or None.
+        """
+        return self.stations.snapshot(station, units or self.units)
+
+    def registerMetric(self, name, function=None, fields=None):
+        """
+        Compute function(*fields) for every observation and put the result
+        in ds.metrics[name]. Without a function, name is one of the
+        metrics.EXTRA_METRICS, e.g. 'wet_bulb' or 'air_density'.
+        """
+        self.metrics.register(name, function, fields)
+
+    def close(self, timeout=None):
+        """ Stop the workers of the queued callbacks and save the state. """
+        for callback in self._queued:
+            callback.close(timeout)
+        if self.store is not None:
+            self.store.checkpoint(self.stations)
+
+    def process(self, data):
+        """
+        Decode and merge a datagram. Returns the message type and the
+        datasets, one for every row of the packet in order, or None when
+        the packet was rejected by the decoder.
+        """
+        msg_type, datasets = self._decoder.decode(data, self._wanted)
+        if not datasets:
+            return msg_type, datasets
+        merge = self._mergers.get(msg_type)
+        if merge is not None:
+            datasets = self._unique(msg_type, datasets)
+            if not datasets:
+                return msg_type, datasets
+            state = self.stations.lookup(datasets[0].hub_sn, datasets[0].serial_number)
+            merged = state.merged
+            metrics = self.metrics
+            for ds in datasets:
+                key = (ds.serial_number, msg_type)
+                last = merged.get(key)
+                if last is not None and ds.timestamp < last:
+                    # dispatched, but it must not overwrite newer values
+                    latest = ds._state = state.latest
+                    if self._mergeLate(msg_type, state, ds):
+                        # its rain changed the total, the snapshot must show it
+                        ds._state = state.publish(latest.timestamp, latest.metrics)
+                    self.stats.late += 1
+                    if metrics:
+                        ds.metrics = metrics.compute(ds)
+                    continue
+                merged[key] = ds.timestamp
+                merge(state, ds)
+                if metrics:
+                    # the fields the packet does not carry come from the live state
+                    ds._state = state
+                    ds.metrics = metrics.compute(ds)
+                # the dataset reads the rest of the station from the snapshot
+                ds._state = state.publish(ds.timestamp, ds.metrics)
+            if self.store is not None:
+                self.store.tick(self.stations)
+        return msg_type, datasets
+
+    def _unique(self, msg_type, datasets):
+        """
+        Returns the observation rows not seen before, counting the others.
+        Rows dated more than MAX_CLOCK_SKEW seconds in the future are
+        dropped even without dedup, as they would hold back the state of
+        their device until that time.
+        """
+        check = self.dedup.checkRow if self.dedup is not None else None
+        limit = time.time() + MAX_CLOCK_SKEW
+        unique = []
+        for ds in datasets:
+            if ds.timestamp is not None and ds.timestamp > limit:
+                reason = 'future'
+            elif check is not None:
+                reason = check(ds.serial_number, msg_type, ds.timestamp)
+            else:
+                reason = None
+            if reason is None:
+                unique.append(ds)
+            else:
+                self.stats.suppress(reason)
+        return unique
+
+    def handle(self, data, received=None):
+        """
+        Process a datagram and dispatch its datasets. received is the
+        stats.clock() time the datagram arrived, for the latency
+        histogram. Repeated datagrams, and stale or future event and
+        status datagrams, are dropped before decoding, and repeated, stale
+        or future observation rows before merging. Packets that fail to decode are
+        counted and logged. Returns the datasets.
+        """
+        stats = self.stats
+        stats.packets += 1
+        if self.dedup is not None:
+            reason = self.dedup.check(data)
+            if reason is not None:
+                stats.suppress(reason)
+                return []
+        try:
+            msg_type, datasets = self.process(data)
+        except (ValueError, KeyError, IndexError, TypeError) as err:
+            cause = errorCause(err)
+            stats.error(cause)
+            _LOGGER.debug("Could not decode packet (%s): %r", cause, data)
+            return []
+        stats.countType(msg_type if msg_type in MESSAGE_TYPES else 'unknown')
+        if datasets is None:
+            stats.error('rejected')
+            _LOGGER.debug("Rejected packet: %r", data)
+            return []
+        if not datasets:
+            if msg_type not in self._wanted:
+                stats.ignored += 1
+            return datasets
+        for ds in datasets:
+            self.dispatch(msg_type, ds, received)
+        return datasets
+
+    def dispatch(self, msg_type, ds, received=None):
+        """ Call the callbacks registered for the message type and station. """
+        stats = self.stats
+        stats.datasets += 1
+        if received is not None:
+            stats.latency.observe(clock() - received)
+        for entry in self._callbacks.get(msg_type, ()):
+            self._call(entry, ds)
+        stations = self._station_callbacks.get(msg_type)
+        if stations:
+            for entry in stations.get(ds.hub_sn, ()):
+                self._call(entry, ds)
+            if ds.serial_number != ds.hub_sn:
+                for entry in stations.get(ds.serial_number, ()):
+                    self._call(entry, ds)
+
+    def _call(self, entry, ds):
+        callback, conv, histogram = entry
+        start = clock()
+        try:
+            callback(ds.inUnits(conv))
+        except Exception:
+            self.stats.error('callback')
+            _LOGGER.exception("Error in callback %s", callbackName(callback))
+        histogram.observe(clock() - start)
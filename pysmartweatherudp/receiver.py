@@ -1,245 +1,336 @@
 """ Interface to receive UDP packages from a Smart Weather station. """
 
 # pylint: disable=import-error
+import collections
+import errno
+import logging
 import os
 import select
 import socket
-import sys
-import json
+import struct
 import threading
-import time
-import datetime
 
-from . import utils
+try:
+    import selectors
+except ImportError:
+    # Python 2, see SelectSelector
+    selectors = None
+
+from .pipeline import Pipeline
+from .stats import MetricsServer, clock, errorCause
 
 from .constants import (
     DEFAULT_HOST,
     DEFAULT_PORT,
-    DEFAULT_UNITS
+    DEFAULT_UNITS,
+    DEDUP_WINDOW,
+    DEFAULT_BATCH_SIZE,
+    MAX_DATAGRAM_SIZE,
+    DROP_OLDEST
 )
 
+_LOGGER = logging.getLogger(__name__)
+
+def isMulticast(host):
+    """ Returns True for an IPv4 or IPv6 multicast group address. """
+    if ':' in host:
+        return host.lower().startswith('ff')
+    try:
+        return 224 <= int(host.split('.')[0]) <= 239
+    except ValueError:
+        return False
+
+def createSocket(host, port, rcvbuf=None, reuse_port=False):
+    """
+    Returns a bound, non-blocking UDP socket. IPv6 addresses open an
+    AF_INET6 socket, and multicast group addresses join the group on
+    all interfaces.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # several processes listen on the same port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf:
+        # a larger kernel queue absorbs bursts while callbacks are running
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.setblocking(False)
+    if not isMulticast(host):
+        sock.bind((host, port))
+    elif family == socket.AF_INET:
+        sock.bind(('', port))
+        mreq = socket.inet_aton(host) + struct.pack('=I', socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    else:
+        sock.bind(('::', port))
+        mreq = socket.inet_pton(socket.AF_INET6, host) + struct.pack('=I', 0)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+    return sock
+
+# selectors.EVENT_READ
+EVENT_READ = 1
+
+SelectorKey = collections.namedtuple('SelectorKey', ('fileobj', 'data'))
+
+class SelectSelector(object):
+    """
+    The part of selectors.DefaultSelector the receiver uses, on top of
+    select(), for Pythons without the selectors module.
+    """
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        self._keys[fileobj] = SelectorKey(fileobj, data)
+
+    def unregister(self, fileobj):
+        del self._keys[fileobj]
+
+    def select(self):
+        rdlist, _, _ = select.select(list(self._keys), [], [])
+        return [(self._keys[fileobj], EVENT_READ) for fileobj in rdlist]
+
+    def close(self):
+        self._keys.clear()
+
+def makeSelector():
+    """ Returns the best selector of the platform, epoll on Linux. """
+    if selectors is None:
+        return SelectSelector()
+    return selectors.DefaultSelector()
+
+class Waker:
+    """
+    A file descriptor that wakes up a selector from another thread: an
+    eventfd where the platform has one, a socket pair otherwise.
+    """
+    def __init__(self):
+        self._pair = None
+        if hasattr(os, 'eventfd'):
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._pair = socket.socketpair()
+            for sock in self._pair:
+                sock.setblocking(False)
+            self._fd = self._pair[0].fileno()
+
+    def fileno(self):
+        return self._fd
+
+    def wake(self):
+        try:
+            if self._pair is None:
+                os.eventfd_write(self._fd, 1)
+            else:
+                self._pair[1].send(b'\0')
+        except (OSError, socket.error) as err:
+            # full, so a wake up is already pending
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def clear(self):
+        try:
+            if self._pair is None:
+                os.eventfd_read(self._fd)
+            else:
+                while self._pair[0].recv(512):
+                    pass
+        except (OSError, socket.error) as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        if self._pair is None:
+            os.close(self._fd)
+        else:
+            for sock in self._pair:
+                sock.close()
+
 class SWReceiver(threading.Thread):
     """ Open a UDP socket to monitor for incoming packets. """
 
-    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, units=DEFAULT_UNITS):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, units=DEFAULT_UNITS,
+                 rcvbuf=None, batch_size=DEFAULT_BATCH_SIZE, recorder=None,
+                 store=None, wind_windows=None, backend=None,
+                 dedup_window=DEDUP_WINDOW, keep_state=True):
         """Construct a Smart Weather interface object."""
         threading.Thread.__init__(self)
         self.stopped = threading.Event()
-        self._callbacks = []
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.setblocking(False)
         self.host = host
         self.port = port
         self.units = units
-        self._socket.bind((host, port))
-        self._state = 'idle'
-
-        """ Variables to store last read state. """
-        # Air Data
-        self._pressure = 0
-        self._temperature = 0
-        self._humidity = 0
-        self._lightning_count = 0
-        self._lightning_distance = 0
-        self._lightning_time = None
-        self._airbattery = 0
-        self._dewpoint = 0
-        self._wind_chill = 0
-        self._heat_index = 0
-        self._feels_like = 0
-        # Sky Data
-        self._precipitation = 0
-        self._precipitation_raw = 0
-        self._precipitation_rate = 0
-        self._precipitation_rate_raw = 0
-        self._precipitation_date = datetime.datetime.today().strftime('%Y-%m-%d')
-        self._illuminance = 0
-        self._uv = 0
-        self._wind_bearing = 0
-        self._wind_speed = 0
-        self._wind_lull = 0
-        self._wind_gust = 0
-        self._skybattery = 0
-        self._solar_radiation = 0
-        self._wind_direction = None
-        # Rapid Wind Data
-        self._wind_bearing_rapid = 0
-        self._wind_speed_rapid = 0
-
-    def registerCallback(self, callback):
-        self._callbacks.append(callback)
+        self._socket = createSocket(host, port, rcvbuf)
+        # Sockets are added and removed by the receive thread, the other
+        # threads queue the change and wake it up.
+        self._selector = makeSelector()
+        self._waker = Waker()
+        self._selector.register(self._waker, EVENT_READ)
+        self._selector.register(self._socket, EVENT_READ, self._socket)
+        self._sockets = (self._socket,)
+        self._changes = collections.deque()
+        # Reusable receive buffer, all pending datagrams are read into it
+        # on every wake up, up to batch_size at a time.
+        self._buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self._view = memoryview(self._buffer)
+        self._batch_size = batch_size
+        # Optional capture.Recorder that gets every raw datagram
+        self.recorder = recorder
+        self._pipeline = Pipeline(units, store, wind_windows, backend, dedup_window, keep_state)
+        # Last read state per station
+        self.stations = self._pipeline.stations
+        # Counters and histograms, see stats.ReceiverStats
+        self.stats = self._pipeline.stats
+
+    @property
+    def sockets(self):
+        """ The sockets being received from. """
+        return self._sockets
+
+    @property
+    def datagrams_read(self):
+        return self.stats.datagrams_read
+
+    @property
+    def wakeups(self):
+        return self.stats.wakeups
+
+    @property
+    def last_batch(self):
+        return self.stats.last_batch
+
+    @property
+    def max_batch(self):
+        return self.stats.max_batch
+
+    def registerCallback(self, callback, station=None, queue_size=None, overflow=DROP_OLDEST,
+                         types=None, units=None):
+        """
+        Register a callback for every dataset, or only for the datasets
+        from one station, given by its hub_sn or a device serial_number.
+        With queue_size the callback runs on its own worker thread, types
+        selects the message types, observations by default, and units the
+        unit system of its datasets, the receiver's by default.
+        """
+        return self._pipeline.registerCallback(callback, station, queue_size, overflow, types,
+                                               units)
+
+    def snapshot(self, station, units=None):
+        """
+        Returns the frozen StationSnapshot of the latest state of a
+        station, given by its hub_sn or a device serial_number, or None.
+        It can be called from any thread and never blocks the receiver.
+        units selects the unit system, the receiver's by default.
+        """
+        return self._pipeline.snapshot(station, units)
+
+    def registerMetric(self, name, function=None, fields=None):
+        """
+        Add a metric computed from the fields of every observation,
+        found in ds.metrics[name]. See metrics.MetricRegistry.
+        """
+        self._pipeline.registerMetric(name, function, fields)
+
+    def feed(self, data):
+        """
+        Process a datagram as if it was received on the socket, used to
+        replay captures. Returns the datasets.
+        """
+        return self._pipeline.handle(data)
+
+    def serveMetrics(self, port=9222, host='127.0.0.1'):
+        """
+        Serve the counters in the Prometheus text format on
+        http://host:port/metrics. Returns the stats.MetricsServer.
+        """
+        return MetricsServer(self.stats, host, port)
+
+    def addSocket(self, host, port=DEFAULT_PORT, rcvbuf=None):
+        """
+        Receive from another address as well, for example a second
+        interface or a multicast group, without restarting the receiver.
+        Returns the new socket.
+        """
+        sock = createSocket(host, port, rcvbuf)
+        self._changes.append((True, sock))
+        self._waker.wake()
+        return sock
+
+    def removeSocket(self, sock):
+        """ Stop receiving from a socket returned by addSocket, and close it. """
+        self._changes.append((False, sock))
+        self._waker.wake()
+
+    def _applyChanges(self):
+        """ Add and remove the queued sockets, in the receive thread. """
+        while self._changes:
+            add, sock = self._changes.popleft()
+            if add:
+                self._selector.register(sock, EVENT_READ, sock)
+                self._sockets = self._sockets + (sock,)
+            elif sock in self._sockets:
+                self._selector.unregister(sock)
+                self._sockets = tuple(s for s in self._sockets if s is not sock)
+                sock.close()
 
     def run(self):
         """Main loop of Smart Weather thread."""
-        while not self.stopped.isSet():
+        selector = self._selector
+        while not self.stopped.is_set():
+            try:
+                count = 0
+                woken = False
+                for key, _ in selector.select():
+                    if key.data is None:
+                        woken = True
+                    else:
+                        count += self._drain(key.data)
+                if count:
+                    self.stats.batch(count)
+                if woken:
+                    # after the reads, so a socket is never read once closed
+                    self._waker.clear()
+                    self._applyChanges()
+            except Exception as err:
+                # keep receiving, but never silently
+                self.stats.error(errorCause(err) if isinstance(err, ValueError) else 'receive')
+                _LOGGER.exception("Error in the receive loop")
+
+    def _drain(self, sock):
+        """ Read and process every pending datagram of a socket. Returns the number read. """
+        count = 0
+        view = self._view
+        while count < self._batch_size:
             try:
-                # if the current state is idle, just block and wait forever
-                # if the current state is any other state, then a timeout of 200ms should
-                # be reasonable in all cases.
-                timeout = (self._state != 'idle') and 0.2 or None
-                rdlist, _, _ = select.select([self._socket.fileno()], [], [], timeout)
-                if not rdlist:
-                    if self._state != 'idle':
-                        self._state = 'idle'
-                    continue
-                data = self._socket.recv(1024)
-                if not data:
-                    # check if the socket is still valid
-                    try:
-                        os.fstat(recv._socket.fileno())
-                    except socket.error:
-                        break
-                    continue
-
-                ds = utils.getDataSet(data, self.units, ignore_errors=True)
-                jsondata = json.loads(data)
-                if jsondata['type'] == 'rapid_wind':
-                    # AIR
-                    ds.pressure = self._pressure
-                    ds.temperature = self._temperature
-                    ds.humidity = self._humidity
-                    ds.lightning_count = self._lightning_count
-                    ds.lightning_distance = self._lightning_distance
-                    ds.lightning_time = self._lightning_time
-                    ds.airbattery = self._airbattery
-                    ds.dewpoint = self._dewpoint
-                    ds.heat_index = self._heat_index
-                    # SKY
-                    ds.illuminance = self._illuminance
-                    ds.uv = self._uv
-                    ds.wind_bearing = self._wind_bearing
-                    ds.wind_speed = self._wind_speed
-                    ds.wind_lull = self._wind_lull
-                    ds.wind_gust = self._wind_gust
-                    ds.solar_radiation = self._solar_radiation
-                    ds.precipitation = self._precipitation
-                    ds.precipitation_rate = self._precipitation_rate
-                    ds.skybattery = self._skybattery
-                    ds.wind_direction = self._wind_direction
-                    # RAPID WIND
-                    self._wind_bearing_rapid = ds.wind_bearing_rapid
-                    self._wind_speed_rapid = ds.wind_speed_rapid
-                    # Calculated Values
-                    self._wind_chill = utils.WeatherFunctions.getWindChill(self, ds.wind_speed, self._temperature)
-                    ds.wind_chill = self._wind_chill
-                    self._feels_like = utils.WeatherFunctions.getFeelsLike(self, self._temperature, self._wind_chill, self._heat_index)
-                    ds.feels_like = self._feels_like
-                elif jsondata['type'] == 'obs_sky':
-                    # AIR
-                    ds.pressure = self._pressure
-                    ds.temperature = self._temperature
-                    ds.humidity = self._humidity
-                    ds.lightning_count = self._lightning_count
-                    ds.lightning_distance = self._lightning_distance
-                    ds.lightning_time = self._lightning_time
-                    ds.airbattery = self._airbattery
-                    ds.dewpoint = self._dewpoint
-                    ds.heat_index = self._heat_index
-                    # RAPID WIND
-                    ds.wind_bearing_rapid = self._wind_bearing_rapid
-                    ds.wind_speed_rapid = self._wind_speed_rapid
-                    # Calculated Values
-                    ds.wind_chill = self._wind_chill
-                    ds.feels_like = self._feels_like
-                    # SKY
-                    self._illuminance = ds.illuminance
-                    self._uv = ds.uv
-                    self._wind_bearing = ds.wind_bearing
-                    self._wind_speed = ds.wind_speed
-                    self._wind_lull = ds.wind_lull
-                    self._wind_gust = ds.wind_gust
-                    self._wind_direction = ds.wind_direction
-                    self._solar_radiation = ds.solar_radiation
-                    self._skybattery = ds.skybattery
-                    self._precipitation_rate_raw = ds.precipitation_rate
-                    self._precipitation_rate = round(self._precipitation_rate_raw * 60,2)
-                    # Reset the Precipitation at Midnight
-                    if datetime.datetime.fromtimestamp(ds.timestamp).strftime('%Y-%m-%d') != self._precipitation_date:
-                        self._precipitation_date = datetime.datetime.fromtimestamp(ds.timestamp).strftime('%Y-%m-%d')
-                        self._precipitation = 0
-                        self._precipitation_raw =0
-                    self._precipitation_raw = self._precipitation_raw + self._precipitation_rate_raw
-                    self._precipitation = round(self._precipitation_raw,1)
-                elif jsondata['type'] == 'obs_air':
-                    # RAPID WIND
-                    ds.wind_bearing_rapid = self._wind_bearing_rapid
-                    ds.wind_speed_rapid = self._wind_speed_rapid
-                    # SKY
-                    ds.illuminance = self._illuminance
-                    ds.uv = self._uv
-                    ds.wind_bearing = self._wind_bearing
-                    ds.wind_speed = self._wind_speed
-                    ds.wind_lull = self._wind_lull
-                    ds.wind_gust = self._wind_gust
-                    ds.solar_radiation = self._solar_radiation
-                    ds.precipitation = self._precipitation
-                    ds.precipitation_rate = self._precipitation_rate
-                    ds.skybattery = self._skybattery
-                    ds.wind_direction = self._wind_direction
-                    # AIR
-                    self._airbattery = ds.airbattery
-                    self._temperature = ds.temperature
-                    self._pressure = ds.pressure
-                    self._humidity = ds.humidity
-                    self._lightning_count = ds.lightning_count
-                    self._lightning_distance = ds.lightning_distance
-                    self._lightning_time = ds.lightning_time
-                    self._dewpoint = ds.dewpoint
-                    self._heat_index = ds.heat_index
-                    # Calculated Values
-                    self._wind_chill = utils.WeatherFunctions.getWindChill(self, self._wind_speed, ds.temperature)
-                    ds.wind_chill = self._wind_chill
-                    self._feels_like = utils.WeatherFunctions.getFeelsLike(self, self._temperature, self._wind_chill, self._heat_index)
-                    ds.feels_like = self._feels_like
-                elif jsondata['type'] == 'obs_st':
-                    # RAPID WIND
-                    ds.wind_bearing_rapid = self._wind_bearing_rapid
-                    ds.wind_speed_rapid = self._wind_speed_rapid
-                    # SKY
-                    self._illuminance = ds.illuminance
-                    self._uv = ds.uv
-                    self._wind_bearing = ds.wind_bearing
-                    self._wind_speed = ds.wind_speed
-                    self._wind_lull = ds.wind_lull
-                    self._wind_gust = ds.wind_gust
-                    self._wind_direction = ds.wind_direction
-                    self._solar_radiation = ds.solar_radiation
-                    self._skybattery = ds.skybattery
-                    self._precipitation_rate_raw = ds.precipitation_rate
-                    self._precipitation_rate = round(self._precipitation_rate_raw * 60,2)
-                    # AIR
-                    self._airbattery = ds.airbattery
-                    self._temperature = ds.temperature
-                    self._pressure = ds.pressure
-                    self._humidity = ds.humidity
-                    self._lightning_count = ds.lightning_count
-                    self._lightning_distance = ds.lightning_distance
-                    self._lightning_time = ds.lightning_time
-                    self._dewpoint = ds.dewpoint
-                    self._heat_index = ds.heat_index
-                    # Calculated Values
-                    self._wind_chill = utils.WeatherFunctions.getWindChill(self, self._wind_speed, ds.temperature)
-                    ds.wind_chill = self._wind_chill
-                    self._feels_like = utils.WeatherFunctions.getFeelsLike(self, self._temperature, self._wind_chill, self._heat_index)
-                    ds.feels_like = self._feels_like
-                else:
-                    ds = None
-
-                if ds:
-                    for callback in self._callbacks:
-                        callback(ds)
-            except:
-                time.sleep(0.1)
+                nbytes = sock.recv_into(self._buffer)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            count += 1
+            if not nbytes:
+                continue
+            received = clock()
+            data = view[:nbytes].tobytes()
+            if self.recorder is not None:
+                self.recorder.write(data)
+            # bad packets are counted by the pipeline, the batch goes on
+            self._pipeline.handle(data, received)
+        return count
 
     def stop(self):
         self.stopped.set()
-        # force receiver thread to wake from select
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.connect((self.host, self.port))
-        msg = "stop"
-        datagram = sys.version_info[0] == 2 and bytes(msg) or bytes(msg, "utf-8")
-        sock.send(datagram)
-        sock.close()
-        self.join()
-        self._socket.close()
+        # wake the receive thread, it returns at once
+        self._waker.wake()
+        if self.ident is not None:
+            self.join()
+        self._applyChanges()
+        for sock in self._sockets:
+            self._selector.unregister(sock)
+            sock.close()
+        self._sockets = ()
+        self._selector.close()
+        self._waker.close()
+        if self.recorder is not None:
+            self.recorder.flush()
+        self._pipeline.close()
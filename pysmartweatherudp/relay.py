@@ -0,0 +1,340 @@
+""" Republish decoded datasets to local processes over a Unix socket. """
+import errno
+import os
+import select
+import socket
+import stat
+import struct
+import threading
+import time
+
+from . import utils
+from .decoder import MESSAGE_TYPES, OBSERVATION_TYPES
+from .events import EVENT_TYPES
+from .rolling import WindSummary
+
+from .constants import (
+    DEFAULT_UNITS,
+    RAW_UNITS
+)
+
+DEFAULT_RELAY_PATH = '/tmp/smartweather.sock'
+# Seconds a new subscriber has to send the types it wants
+HANDSHAKE_TIMEOUT = 5
+
+# Frame: encoding version and message type index, then the slots of the
+# dataset in order, each a tag byte followed by its value.
+ENCODING_VERSION = 1
+_FRAME = struct.Struct('<BB')
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_LENGTH = struct.Struct('<H')
+
+# Message types by index in the frames, and their classes and slots
+RELAY_TYPES = tuple(sorted(MESSAGE_TYPES))
+_CLASSES = dict(utils.DATASET_TYPES.items())
+_CLASSES.update(EVENT_TYPES)
+_SCHEMAS = []
+for _msg_type in RELAY_TYPES:
+    _cls = _CLASSES[_msg_type][0]
+    _fields = utils.FIELDS if _msg_type in OBSERVATION_TYPES else \
+        tuple(name for name in _cls.__slots__ if name not in ('_views', '_state'))
+    _SCHEMAS.append((_cls, _fields))
+_INDEXES = dict((cls, index) for index, (cls, _) in enumerate(_SCHEMAS))
+
+
+def _pack(value, out):
+    if value is None:
+        out.append(b'N')
+    elif isinstance(value, int):
+        out.append(b'i' + _INT.pack(value))
+    elif isinstance(value, float):
+        out.append(b'd' + _FLOAT.pack(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(b's' + _LENGTH.pack(len(data)) + data)
+    elif isinstance(value, dict):
+        out.append(b'm' + _LENGTH.pack(len(value)))
+        for key, item in value.items():
+            _pack(key, out)
+            _pack(item, out)
+    elif isinstance(value, (tuple, list)):
+        out.append(b't' + _LENGTH.pack(len(value)))
+        for item in value:
+            _pack(item, out)
+    else:
+        raise TypeError('Cannot relay a %s' % type(value).__name__)
+
+
+def _unpack(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == b'N':
+        return None, offset
+    if tag == b'i':
+        return _INT.unpack_from(data, offset)[0], offset + 8
+    if tag == b'd':
+        return _FLOAT.unpack_from(data, offset)[0], offset + 8
+    count = _LENGTH.unpack_from(data, offset)[0]
+    offset += 2
+    if tag == b's':
+        return data[offset:offset + count].decode('utf-8'), offset + count
+    if tag == b'm':
+        value = {}
+        for _ in range(count):
+            key, offset = _unpack(data, offset)
+            value[key], offset = _unpack(data, offset)
+        return value, offset
+    if tag == b't':
+        items = []
+        for _ in range(count):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        return tuple(items), offset
+    raise ValueError('Bad relay frame')
+
+
+def encodeRecord(ds):
+    """ Returns the frame for a dataset or event, in its own units. """
+    index = _INDEXES[ds.__class__]
+    out = [_FRAME.pack(ENCODING_VERSION, index)]
+    for name in _SCHEMAS[index][1]:
+        _pack(getattr(ds, name), out)
+    return b''.join(out)
+
+
+def decodeRecord(data):
+    """ Returns (message type, dataset) for a frame made by encodeRecord. """
+    version, index = _FRAME.unpack_from(data)
+    if version != ENCODING_VERSION or index >= len(_SCHEMAS):
+        raise ValueError('Unknown relay frame')
+    cls, fields = _SCHEMAS[index]
+    ds = cls.__new__(cls)
+    offset = _FRAME.size
+    for name in fields:
+        value, offset = _unpack(data, offset)
+        setattr(ds, name, value)
+    if hasattr(cls, 'copy'):
+        ds._views = None
+    if hasattr(cls, '_state'):
+        ds._state = None
+    windows = getattr(ds, 'wind_windows', None)
+    if windows:
+        ds.wind_windows = dict((window, WindSummary(*summary)) for window, summary in windows.items())
+    return RELAY_TYPES[index], ds
+
+
+class _Subscriber(object):
+    __slots__ = ('sock', 'types', 'sent', 'dropped')
+
+    def __init__(self, sock, types):
+        self.sock = sock
+        self.types = types
+        self.sent = 0
+        self.dropped = 0
+
+
+def _removeStale(path):
+    """
+    Remove the socket a relay left at path, raising socket.error when
+    path is something else or a relay still listens on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise socket.error(errno.EEXIST, '%s exists and is not a socket' % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        probe.connect(path)
+    except socket.error as err:
+        if err.errno != errno.ECONNREFUSED:
+            raise
+        # nobody listens, left over from a previous run
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise socket.error(errno.EADDRINUSE, 'A relay is already running on %s' % path)
+
+
+class Relay:
+    """
+    Serve the datasets of one receiver to any number of local processes,
+    so only one of them has to own the UDP port:
+
+        relay = Relay('/run/smartweather.sock').register(receiver)
+
+    Subscribers (RelaySubscriber) connect to a Unix SOCK_SEQPACKET socket
+    at path and may come and go at any time. Each dataset is encoded once,
+    in raw units, and the same frame is sent to every subscriber that asked
+    for its message type. Sends never block: a subscriber whose socket
+    buffer is full misses the frame, and one that went away is detached.
+
+    A socket left at path by a relay that is gone is replaced; anything
+    else there, including the socket of a running relay, raises
+    socket.error.
+    """
+    def __init__(self, path=DEFAULT_RELAY_PATH, types=None):
+        self.path = path
+        self.types = frozenset(types or MESSAGE_TYPES)
+        # replaced as a whole when subscribers come and go
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self.published = 0
+        _removeStale(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._socket.bind(path)
+        self._socket.listen(16)
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, receiver):
+        """ Register with a receiver for the relayed types, in raw units. Returns self. """
+        receiver.registerCallback(self, types=self.types, units=RAW_UNITS)
+        return self
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def _accept(self):
+        # sockets accepted but that did not send their types yet: deadline
+        pending = {}
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(pending.values()) - time.time())
+            try:
+                readable, _, _ = select.select([self._socket] + list(pending), [], [], timeout)
+            except (select.error, socket.error, OSError, ValueError):
+                readable = [self._socket]
+            for sock in readable:
+                if sock is self._socket:
+                    try:
+                        sock, _ = self._socket.accept()
+                    except (socket.error, OSError):
+                        # the relay was closed
+                        for sock in pending:
+                            sock.close()
+                        return
+                    sock.setblocking(False)
+                    pending[sock] = time.time() + HANDSHAKE_TIMEOUT
+                    continue
+                del pending[sock]
+                self._attach(sock)
+            now = time.time()
+            for sock, deadline in list(pending.items()):
+                if deadline <= now:
+                    # it never said what it wants
+                    del pending[sock]
+                    sock.close()
+
+    def _attach(self, sock):
+        """ Read the types a new subscriber starts with, then start sending to it. """
+        try:
+            wanted = sock.recv(4096).decode('ascii')
+        except (socket.error, OSError, UnicodeDecodeError):
+            wanted = ''
+        if not wanted:
+            sock.close()
+            return
+        types = frozenset(t for t in wanted.split(',') if t in self.types) or OBSERVATION_TYPES
+        with self._lock:
+            self._subscribers = self._subscribers + (_Subscriber(sock, types),)
+
+    def _detach(self, subscriber):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+        subscriber.sock.close()
+
+    def __call__(self, ds):
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        msg_type = RELAY_TYPES[_INDEXES[ds.__class__]]
+        frame = None
+        for subscriber in subscribers:
+            if msg_type not in subscriber.types:
+                continue
+            if frame is None:
+                frame = encodeRecord(ds)
+            try:
+                subscriber.sock.send(frame)
+                subscriber.sent += 1
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    subscriber.dropped += 1
+                else:
+                    self._detach(subscriber)
+        if frame is not None:
+            self.published += 1
+
+    def close(self):
+        """ Stop accepting, disconnect the subscribers and remove the socket. """
+        try:
+            # wakes up the accept thread
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self._socket.close()
+        self._thread.join(1)
+        for subscriber in self._subscribers:
+            subscriber.sock.close()
+        self._subscribers = ()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class RelaySubscriber:
+    """
+    Receive the datasets of a Relay in another process. types lists the
+    message types wanted, observations by default, and units the unit
+    system of the datasets:
+
+        with RelaySubscriber('/run/smartweather.sock') as subscriber:
+            for msg_type, ds in subscriber:
+                ...
+    """
+    def __init__(self, path=DEFAULT_RELAY_PATH, types=None, units=DEFAULT_UNITS):
+        self.path = path
+        self.units = units
+        self.types = frozenset(types or OBSERVATION_TYPES)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._socket.connect(path)
+        self._socket.send(','.join(sorted(self.types)).encode('ascii'))
+
+    def get(self, timeout=None):
+        """
+        Returns the next (message type, dataset), or None when the timeout
+        expired or the relay went away.
+        """
+        self._socket.settimeout(timeout)
+        try:
+            frame = self._socket.recv(65536)
+        except socket.timeout:
+            return None
+        if not frame:
+            return None
+        msg_type, ds = decodeRecord(frame)
+        return msg_type, ds.inUnits(self.units)
+
+    def __iter__(self):
+        while True:
+            record = self.get()
+            if record is None:
+                return
+            yield record
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,91 @@
+""" Rolling window statistics over the rapid_wind readings. """
+import collections
+import math
+
+# Statistics of one window, attached to the datasets as wind_windows
+WindSummary = collections.namedtuple('WindSummary', 'window samples average gust lull bearing')
+
+
+class RollingWind:
+    """
+    Wind speed and bearing over the last window seconds of rapid_wind
+    readings. Each reading is O(1) amortized: running sums give the average
+    and the speed weighted mean bearing, and monotonic deques keep the
+    maximum (gust) and minimum (lull) without rescanning the window.
+    Time is taken from the packets, so replays give the same results.
+    """
+    __slots__ = ('window', '_samples', '_maxq', '_minq', '_sum', '_x', '_y')
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = collections.deque()
+        self._maxq = collections.deque()
+        self._minq = collections.deque()
+        self._sum = 0.0
+        self._x = 0.0
+        self._y = 0.0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, timestamp, speed, bearing):
+        """ Add a reading and drop the ones that left the window. """
+        rad = math.radians(bearing)
+        x = speed * math.sin(rad)
+        y = speed * math.cos(rad)
+        self._samples.append((timestamp, speed, x, y))
+        self._sum += speed
+        self._x += x
+        self._y += y
+        maxq = self._maxq
+        while maxq and maxq[-1][1] <= speed:
+            maxq.pop()
+        maxq.append((timestamp, speed))
+        minq = self._minq
+        while minq and minq[-1][1] >= speed:
+            minq.pop()
+        minq.append((timestamp, speed))
+        self._evict(timestamp - self.window)
+
+    def _evict(self, limit):
+        samples = self._samples
+        while samples[0][0] <= limit:
+            _, speed, x, y = samples.popleft()
+            self._sum -= speed
+            self._x -= x
+            self._y -= y
+        while self._maxq[0][0] <= limit:
+            self._maxq.popleft()
+        while self._minq[0][0] <= limit:
+            self._minq.popleft()
+
+    def summary(self):
+        """ Returns the WindSummary of the readings in the window. """
+        count = len(self._samples)
+        if not count:
+            return WindSummary(self.window, 0, 0, 0, 0, None)
+        bearing = int(round(math.degrees(math.atan2(self._x, self._y)))) % 360
+        return WindSummary(
+            self.window,
+            count,
+            round(max(self._sum, 0.0) / count, 1),
+            self._maxq[0][1],
+            self._minq[0][1],
+            bearing,
+        )
+
+
+class RollingWindSet:
+    """ One RollingWind per configured window length, fed together. """
+    __slots__ = ('_windows',)
+
+    def __init__(self, windows):
+        self._windows = [RollingWind(window) for window in windows]
+
+    def add(self, timestamp, speed, bearing):
+        """ Add a reading to every window. Returns the summaries by window. """
+        summaries = {}
+        for rolling in self._windows:
+            rolling.add(timestamp, speed, bearing)
+            summaries[rolling.window] = rolling.summary()
+        return summaries
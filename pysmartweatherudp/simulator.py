@@ -0,0 +1,225 @@
+""" Simulated WeatherFlow hubs, to exercise a receiver without hardware.
+
+Send the packets of 10 virtual stations at 500 packets/s for a minute:
+    python -m pysmartweatherudp.simulator --stations 10 --rate 500 --duration 60
+"""
+import argparse
+import json
+import random
+import socket
+import time
+
+from .constants import DEFAULT_PORT
+
+# Malformed packets sent with the malformed option, by kind
+MALFORMED_KINDS = ('truncated', 'short_array', 'bad_type', 'garbage')
+
+
+class VirtualStation:
+    """
+    One hub with a Tempest, or with an AIR and a SKY, whose readings drift
+    like real weather. Every method returns the datagram of one message.
+    """
+    def __init__(self, index, tempest=True, rng=None):
+        self.rng = rng or random.Random(index)
+        self.tempest = tempest
+        self.hub_sn = 'HB-%08d' % (index + 1)
+        if tempest:
+            self.serials = ['ST-%08d' % (index + 1)]
+        else:
+            self.serials = ['AR-%08d' % (index + 1), 'SK-%08d' % (index + 1)]
+        rng = self.rng
+        self.temperature = rng.uniform(-5, 30)
+        self.humidity = rng.uniform(30, 95)
+        self.pressure = rng.uniform(990, 1030)
+        self.wind = rng.uniform(0, 8)
+        self.bearing = rng.randrange(360)
+        self.illuminance = rng.uniform(0, 80000)
+        self.raining = False
+        self.seq = 0
+
+    def _drift(self, value, step, low, high):
+        return min(high, max(low, value + self.rng.uniform(-step, step)))
+
+    def _message(self, serial_number, msg_type, **values):
+        message = {'serial_number': serial_number, 'type': msg_type, 'hub_sn': self.hub_sn}
+        message.update(values)
+        return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+    def rapidWind(self, timestamp):
+        self.wind = self._drift(self.wind, 0.6, 0, 30)
+        self.bearing = int(self._drift(self.bearing, 15, 0, 359))
+        return self._message(self.serials[-1], 'rapid_wind',
+                             ob=[timestamp, round(self.wind, 2), self.bearing])
+
+    def observations(self, timestamp):
+        """ Returns the obs_st, or the obs_air and obs_sky datagrams. """
+        rng = self.rng
+        self.temperature = self._drift(self.temperature, 0.2, -30, 45)
+        self.humidity = self._drift(self.humidity, 1, 5, 100)
+        self.pressure = self._drift(self.pressure, 0.3, 950, 1050)
+        self.illuminance = self._drift(self.illuminance, 2000, 0, 120000)
+        if rng.random() < 0.02:
+            self.raining = not self.raining
+        rain = round(rng.uniform(0, 0.3), 3) if self.raining else 0.0
+        strikes = rng.randrange(3) if rng.random() < 0.02 else 0
+        distance = rng.randrange(1, 40) if strikes else 0
+        lull = round(self.wind * 0.5, 2)
+        gust = round(self.wind * 1.5, 2)
+        uv = round(self.illuminance / 12000.0, 2)
+        solar = int(self.illuminance / 120)
+        if self.tempest:
+            return [self._message(self.serials[0], 'obs_st', obs=[[
+                timestamp, lull, round(self.wind, 2), gust, self.bearing, 3,
+                round(self.pressure, 2), round(self.temperature, 2), round(self.humidity, 2),
+                int(self.illuminance), uv, solar, rain, 1 if rain else 0, distance, strikes,
+                2.41, 1]], firmware_revision=129)]
+        return [
+            self._message(self.serials[0], 'obs_air', obs=[[
+                timestamp, round(self.pressure, 2), round(self.temperature, 2),
+                round(self.humidity, 2), strikes, distance, 3.46, 1]], firmware_revision=17),
+            self._message(self.serials[1], 'obs_sky', obs=[[
+                timestamp, int(self.illuminance), uv, rain, lull, round(self.wind, 2), gust,
+                self.bearing, 3.12, 1, solar, None, 1 if rain else 0, 3]], firmware_revision=29),
+        ]
+
+    def event(self, timestamp):
+        """ Returns an evt_strike or evt_precip datagram. """
+        if self.rng.random() < 0.5:
+            return self._message(self.serials[0], 'evt_strike',
+                                 evt=[timestamp, self.rng.randrange(1, 40), self.rng.randrange(10000)])
+        return self._message(self.serials[-1], 'evt_precip', evt=[timestamp])
+
+    def status(self, timestamp):
+        """ Returns the device_status of every device and the hub_status. """
+        self.seq += 1
+        datagrams = [self._message(serial, 'device_status', timestamp=timestamp, uptime=self.seq * 60,
+                                   voltage=2.41, firmware_revision=129, rssi=-60, hub_rssi=-62,
+                                   sensor_status=0, debug=0)
+                     for serial in self.serials]
+        hub = {'serial_number': self.hub_sn, 'type': 'hub_status', 'firmware_revision': '171',
+               'uptime': self.seq * 60, 'rssi': -50, 'timestamp': timestamp,
+               'reset_flags': 'BOR,PIN,POR', 'seq': self.seq}
+        datagrams.append(json.dumps(hub, separators=(',', ':')).encode('utf-8'))
+        return datagrams
+
+
+def corrupt(data, rng=random):
+    """ Returns a malformed version of a datagram and its kind. """
+    kind = rng.choice(MALFORMED_KINDS)
+    if kind == 'truncated':
+        return data[:rng.randrange(1, len(data))], kind
+    if kind == 'garbage':
+        return bytes(bytearray(rng.randrange(256) for _ in range(rng.randrange(1, 64)))), kind
+    message = json.loads(data)
+    key = 'ob' if 'ob' in message else 'obs' if 'obs' in message else 'evt' if 'evt' in message else None
+    if key is None:
+        # status messages have no array to break
+        return data[:len(data) // 2], 'truncated'
+    row = message[key][0] if key == 'obs' else message[key]
+    if kind == 'short_array':
+        del row[1:]
+    else:
+        row[0] = 'now'
+    return json.dumps(message).encode('utf-8'), kind
+
+
+def stream(stations=1, tempest=True, obs_every=20, status_every=20, events=0.0,
+           malformed=0.0, duplicates=0.0, precise=False, seed=None, clock=time.time):
+    """
+    Yields (datagram, kind) endlessly, kind being 'valid', 'duplicate' or
+    one of MALFORMED_KINDS. Each round gives every station a rapid_wind;
+    every obs_every rounds the observations and every status_every rounds
+    the status messages are added, like the 3 s and 60 s intervals of a
+    real hub. events, malformed and duplicates are the probabilities of
+    an event after a packet, of a packet being malformed and of a packet
+    being sent twice. Timestamps come from clock at the time a datagram
+    is made, whole seconds unless precise.
+    """
+    rng = random.Random(seed)
+    fleet = [VirtualStation(index, tempest, random.Random(rng.random())) for index in range(stations)]
+    round_ = 0
+    while True:
+        for station in fleet:
+            timestamp = clock() if precise else int(clock())
+            datagrams = [station.rapidWind(timestamp)]
+            if round_ % obs_every == 0:
+                datagrams.extend(station.observations(timestamp))
+            if round_ % status_every == status_every // 2:
+                datagrams.extend(station.status(timestamp))
+            if events and rng.random() < events:
+                datagrams.append(station.event(timestamp))
+            for data in datagrams:
+                if malformed and rng.random() < malformed:
+                    yield corrupt(data, rng)
+                    continue
+                yield data, 'valid'
+                if duplicates and rng.random() < duplicates:
+                    yield data, 'duplicate'
+        round_ += 1
+
+
+def send(host='127.0.0.1', port=DEFAULT_PORT, rate=None, duration=None, count=None, burst=1,
+         **options):
+    """
+    Send the datagrams of stream(**options) to host:port. rate is in
+    packets per second, sent burst packets at a time; without a rate every
+    station sends a rapid_wind every 3 seconds. Stops after duration
+    seconds or count packets. Returns the number sent by kind.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if rate is None:
+        rate = options.get('stations', 1) / 3.0
+    interval = burst / float(rate)
+    sent = {}
+    start = time.time()
+    deadline = start
+    total = 0
+    packets = stream(**options)
+    try:
+        while (duration is None or time.time() - start < duration) and \
+                (count is None or total < count):
+            for _ in range(burst):
+                data, kind = next(packets)
+                try:
+                    sock.sendto(data, (host, port))
+                except socket.error:
+                    kind = 'send_error'
+                sent[kind] = sent.get(kind, 0) + 1
+                total += 1
+            deadline += interval
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        sock.close()
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send the packets of simulated WeatherFlow hubs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--stations', type=int, default=1)
+    parser.add_argument('--air-sky', action='store_true', help='AIR and SKY units instead of a Tempest')
+    parser.add_argument('--rate', type=float, help='packets per second, default as a real hub')
+    parser.add_argument('--burst', type=int, default=1, help='packets sent back to back')
+    parser.add_argument('--duration', type=float, help='seconds to run, default forever')
+    parser.add_argument('--events', type=float, default=0.0, help='probability of an event per packet')
+    parser.add_argument('--malformed', type=float, default=0.0, help='fraction of malformed packets')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='fraction of packets sent twice')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    try:
+        sent = send(args.host, args.port, args.rate, args.duration, burst=args.burst,
+                    stations=args.stations, tempest=not args.air_sky, events=args.events,
+                    malformed=args.malformed, duplicates=args.duplicates, seed=args.seed)
+    except KeyboardInterrupt:
+        return
+    for kind, number in sorted(sent.items()):
+        print('%-12s %d' % (kind, number))
+
+
+if __name__ == '__main__':
+    main()
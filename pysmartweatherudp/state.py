@@ -0,0 +1,217 @@
+""" Last known state for each station seen on the network. """
+import collections
+import datetime
+import operator
+import time
+
+from . import utils
+from .constants import RAW_UNITS
+
+
+# Accumulators and bookkeeping kept next to the last read values
+_ACCUMULATOR_FIELDS = ('precipitation_raw', 'precipitation_rate_raw', 'precipitation_date')
+# Values frozen into every StationSnapshot, read in one call
+_SNAPSHOT_VALUES = utils.STATE_FIELDS + utils.ROLLING_FIELDS
+_stateValues = operator.attrgetter(*_SNAPSHOT_VALUES)
+
+def _dayBounds(timestamp):
+    """ Returns the local date and the epoch range of the day holding timestamp. """
+    day = datetime.date.fromtimestamp(timestamp)
+    start = time.mktime(day.timetuple())
+    end = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+    return day.strftime('%Y-%m-%d'), start, end
+
+class StationState(object):
+    """
+    Last read values for one station, in raw units. A station is a hub,
+    so the AIR and SKY units attached to the same hub are merged into
+    one state.
+    """
+    __slots__ = ('hub_sn', 'serial_numbers', 'precipitation_day_start',
+                 'precipitation_day_end', 'precipitation_time', 'wind_rolling', 'latest', 'merged',
+                 '_views') + \
+        _ACCUMULATOR_FIELDS + \
+        utils.STATE_FIELDS + utils.ROLLING_FIELDS
+
+    def __init__(self, hub_sn):
+        self.hub_sn = hub_sn
+        self.serial_numbers = set()
+        for name in utils.STATE_FIELDS:
+            setattr(self, name, 0)
+        self.lightning_time = None
+        self.wind_direction = None
+        self.wind_windows = None
+        self.wind_rolling = None
+        # StationSnapshot of the last merge, replaced as a whole
+        self.latest = None
+        # unit system: (snapshot, the snapshot in those units)
+        self._views = {}
+        # newest timestamp merged, by (serial_number, message type)
+        self.merged = {}
+        self.precipitation_raw = 0
+        self.precipitation_rate_raw = 0
+        # timestamp of the newest rain reading
+        self.precipitation_time = None
+        self.precipitation_date, self.precipitation_day_start, self.precipitation_day_end = _dayBounds(time.time())
+
+    def accumulatePrecipitation(self, timestamp, amount):
+        """ Add the rain of one minute to the total since midnight. """
+        late = self.precipitation_time is not None and timestamp < self.precipitation_time
+        # Reset the Precipitation at Midnight
+        if not self.precipitation_day_start <= timestamp < self.precipitation_day_end:
+            if late:
+                # rain of a day that is already closed
+                return
+            self.precipitation_date, self.precipitation_day_start, self.precipitation_day_end = _dayBounds(timestamp)
+            self.precipitation = 0
+            self.precipitation_raw = 0
+        if not late:
+            self.precipitation_time = timestamp
+            self.precipitation_rate_raw = amount
+            self.precipitation_rate = round(amount * 60,2)
+        self.precipitation_raw = self.precipitation_raw + amount
+        self.precipitation = round(self.precipitation_raw,1)
+
+    def publish(self, timestamp, metrics=None):
+        """
+        Swap in a frozen copy of the values as the snapshot of the
+        station, after an observation at timestamp was merged. Returns it.
+        """
+        latest = self.latest
+        version = latest.version + 1 if latest is not None else 1
+        snapshot = tuple.__new__(StationSnapshot, (version, self.hub_sn, timestamp) +
+                                 _stateValues(self) + (dict(metrics) if metrics else None,))
+        self.latest = snapshot
+        return snapshot
+
+    def snapshot(self, units=RAW_UNITS):
+        """ Returns the StationSnapshot of the last merge in a unit system, or None. """
+        snapshot = self.latest
+        if snapshot is None:
+            return None
+        conv = utils.getConverters(units)
+        if conv.raw:
+            return snapshot
+        # readers may race here, the worst case is converting twice
+        cached = self._views.get(conv)
+        if cached is not None and cached[0] is snapshot:
+            return cached[1]
+        view = snapshot.inUnits(conv)
+        self._views[conv] = (snapshot, view)
+        return view
+
+    def asDict(self):
+        """ Returns the values and accumulators as a dictionary. """
+        values = dict((name, getattr(self, name)) for name in _ACCUMULATOR_FIELDS + utils.STATE_FIELDS)
+        values['hub_sn'] = self.hub_sn
+        values['timestamp'] = self.latest.timestamp if self.latest is not None else None
+        values['serial_numbers'] = sorted(self.serial_numbers)
+        return values
+
+    def restore(self, values):
+        """
+        Load values saved by asDict and publish them as the snapshot.
+        Unknown names are ignored.
+        """
+        for name in _ACCUMULATOR_FIELDS + utils.STATE_FIELDS:
+            if name in values:
+                setattr(self, name, values[name])
+        day = datetime.datetime.strptime(self.precipitation_date, '%Y-%m-%d')
+        _, self.precipitation_day_start, self.precipitation_day_end = _dayBounds(time.mktime(day.timetuple()))
+        self.publish(values.get('timestamp'))
+
+
+class StationSnapshot(collections.namedtuple(
+        'StationSnapshot', ('version', 'hub_sn', 'timestamp') + _SNAPSHOT_VALUES + utils.METRIC_FIELDS)):
+    """
+    Frozen copy of the state of a station, made every time an observation
+    is merged into it. It has the fields of a merged dataset that belong
+    to the station, with the meaning they have in the state whatever the
+    last packet was: precipitation_rate is per hour, like in a merged
+    obs_air dataset. timestamp is the one of the last merged observation
+    and version counts the merges. Being a tuple it cannot be changed,
+    and it costs one copy of the values per merge.
+    """
+    __slots__ = ()
+
+    def inUnits(self, units):
+        """ Returns the snapshot in a unit system, itself for raw units. """
+        conv = utils.getConverters(units)
+        if conv.raw:
+            return self
+        changes = {}
+        for name, kind in utils.UNIT_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                changes[name] = getattr(conv, kind)(value)
+        if self.wind_windows:
+            changes['wind_windows'] = utils.convertWindows(self.wind_windows, conv)
+        return self._replace(**changes)
+
+    def asDict(self):
+        """ Returns the fields as a dictionary. """
+        return self._asdict()
+
+    def __repr__(self):
+        return '<StationSnapshot %s v%d>' % (self.hub_sn, self.version)
+
+
+class StationTable:
+    """
+    Station states keyed by hub_sn, with a second index by the
+    serial_number of every device reporting through the hub.
+    """
+    def __init__(self):
+        self._hubs = {}
+        self._devices = {}
+
+    def __len__(self):
+        return len(self._hubs)
+
+    def __iter__(self):
+        return iter(self._hubs.values())
+
+    def get(self, key):
+        """ Returns the state for a hub_sn or device serial_number, or None. """
+        state = self._hubs.get(key)
+        if state is None:
+            state = self._devices.get(key)
+        return state
+
+    def snapshot(self, key, units=RAW_UNITS):
+        """
+        Returns the StationSnapshot for a hub_sn or device serial_number,
+        or None. Safe to call from any thread, it never blocks.
+        """
+        state = self.get(key)
+        if state is None:
+            return None
+        return state.snapshot(units)
+
+    def lookup(self, hub_sn, serial_number):
+        """ Returns the state for a packet, creating it on first sight. """
+        state = self._devices.get(serial_number)
+        if state is not None and state.hub_sn == hub_sn:
+            return state
+        state = self._hubs.get(hub_sn)
+        if state is None:
+            state = self._hubs[hub_sn] = StationState(hub_sn)
+        if serial_number is not None:
+            old = self._devices.get(serial_number)
+            if old is not None:
+                # the device moved to another hub
+                old.serial_numbers.discard(serial_number)
+            state.serial_numbers.add(serial_number)
+            self._devices[serial_number] = state
+        return state
+
+    def restore(self, values):
+        """ Add a station saved by StationState.asDict. """
+        state = self._hubs.get(values['hub_sn'])
+        if state is None:
+            state = self._hubs[values['hub_sn']] = StationState(values['hub_sn'])
+        state.restore(values)
+        for serial_number in values.get('serial_numbers', ()):
+            state.serial_numbers.add(serial_number)
+            self._devices[serial_number] = state
+        return state
@@ -0,0 +1,271 @@
+""" Counters and histograms for the receive path, with a Prometheus export. """
+import bisect
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+# Upper bounds in seconds, for packet latency and callback run time
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Decode errors by exception type
+ERROR_CAUSES = (
+    (KeyError, 'missing_field'),
+    (IndexError, 'short_array'),
+    (TypeError, 'bad_type'),
+    (ValueError, 'bad_value'),
+)
+
+
+def errorCause(err):
+    """ Returns the error counter name for a decode exception. """
+    if err.__class__.__name__ == 'JSONDecodeError' or str(err).startswith('No JSON'):
+        return 'invalid_json'
+    for cls, cause in ERROR_CAUSES:
+        if isinstance(err, cls):
+            return cause
+    return 'other'
+
+
+def callbackName(callback):
+    """ Returns a readable name for a callback, used as its label. """
+    callback = getattr(callback, 'callback', callback)
+    name = getattr(callback, '__name__', None) or callback.__class__.__name__
+    module = getattr(callback, '__module__', None)
+    return '%s.%s' % (module, name) if module else name
+
+
+class Histogram(object):
+    """ Counts observations into fixed buckets. Observing is a bisect. """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the highest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Returns the bucket bound holding the q quantile, None if empty. """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def asDict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip(self.buckets, self.counts)),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class ReceiverStats:
+    """
+    Counters of one receiver. Everything is updated by the receiving
+    thread only, so there is no locking; readers may see a packet or two
+    less than was counted.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.packets = 0
+        self.datasets = 0
+        self.ignored = 0
+        # observation rows older than the newest merged of their device
+        self.late = 0
+        self.wakeups = 0
+        self.datagrams_read = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.by_type = {}
+        self.errors = {}
+        # duplicate, stale and future datagrams and observation rows dropped
+        self.suppressed = {}
+        self.latency = Histogram()
+        # label: run time Histogram, and callback: label
+        self.callbacks = {}
+        self._labels = {}
+        # QueuedCallbacks, for their dropped counts
+        self.queued = []
+
+    def countType(self, msg_type):
+        self.by_type[msg_type] = self.by_type.get(msg_type, 0) + 1
+
+    def error(self, cause):
+        self.errors[cause] = self.errors.get(cause, 0) + 1
+
+    def suppress(self, reason):
+        self.suppressed[reason] = self.suppressed.get(reason, 0) + 1
+
+    def batch(self, count):
+        """ Count a wake up of the receiver that read count datagrams. """
+        self.wakeups += 1
+        self.datagrams_read += count
+        self.last_batch = count
+        if count > self.max_batch:
+            self.max_batch = count
+
+    def callbackLabel(self, callback):
+        """
+        Returns the label of a callback, its name followed by #2, #3...
+        when other callbacks, e.g. lambdas, already have that name.
+        """
+        key = callback
+        try:
+            hash(key)
+        except TypeError:
+            key = id(callback)
+        label = self._labels.get(key)
+        if label is None:
+            name = label = callbackName(callback)
+            taken = set(self._labels.values())
+            index = 1
+            while label in taken:
+                index += 1
+                label = '%s#%d' % (name, index)
+            self._labels[key] = label
+        return label
+
+    def callbackHistogram(self, callback):
+        """ Returns the run time histogram of a callback, shared when it is registered again. """
+        label = self.callbackLabel(callback)
+        histogram = self.callbacks.get(label)
+        if histogram is None:
+            histogram = self.callbacks[label] = Histogram()
+        return histogram
+
+    def dropped(self):
+        """ Returns the datasets dropped by the queued callbacks, by label. """
+        return dict((self.callbackLabel(q), q.dropped) for q in self.queued)
+
+    def asDict(self):
+        """ Returns all counters as a dictionary. """
+        return {
+            'uptime': time.time() - self.started,
+            'packets': self.packets,
+            'datasets': self.datasets,
+            'ignored': self.ignored,
+            'late': self.late,
+            'wakeups': self.wakeups,
+            'datagrams_read': self.datagrams_read,
+            'last_batch': self.last_batch,
+            'max_batch': self.max_batch,
+            'by_type': dict(self.by_type),
+            'errors': dict(self.errors),
+            'suppressed': dict(self.suppressed),
+            'dropped': self.dropped(),
+            'latency': self.latency.asDict(),
+            'callbacks': dict((name, h.asDict()) for name, h in self.callbacks.items()),
+        }
+
+    def prometheus(self, prefix='smartweather'):
+        """ Returns the counters in the Prometheus text exposition format. """
+        lines = []
+        def metric(name, kind, helptext, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, helptext))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for labels, value in samples:
+                lines.append('%s_%s%s %s' % (prefix, name, labels, _number(value)))
+        def histogram(name, helptext, histograms):
+            samples = []
+            for labels, h in histograms:
+                total = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    total += count
+                    samples.append(('_bucket', _labels(labels, le=_number(bound)), total))
+                samples.append(('_bucket', _labels(labels, le='+Inf'), h.count))
+                samples.append(('_sum', _labels(labels), h.sum))
+                samples.append(('_count', _labels(labels), h.count))
+            lines.append('# HELP %s_%s %s' % (prefix, name, helptext))
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for suffix, labels, value in samples:
+                lines.append('%s_%s%s%s %s' % (prefix, name, suffix, labels, _number(value)))
+
+        metric('packets_total', 'counter', 'Datagrams handed to the decoder.', [('', self.packets)])
+        metric('packets_by_type_total', 'counter', 'Datagrams by message type.',
+               [(_labels({'type': t}), n) for t, n in sorted(self.by_type.items())])
+        metric('datasets_total', 'counter', 'Datasets dispatched to callbacks.', [('', self.datasets)])
+        metric('ignored_total', 'counter', 'Datagrams of types nobody subscribed to.', [('', self.ignored)])
+        metric('late_total', 'counter', 'Observation rows older than the state, not merged into it.',
+               [('', self.late)])
+        metric('errors_total', 'counter', 'Errors by cause.',
+               [(_labels({'cause': c}), n) for c, n in sorted(self.errors.items())])
+        metric('suppressed_total', 'counter', 'Duplicate, stale and future dated datagrams and rows dropped.',
+               [(_labels({'reason': r}), n) for r, n in sorted(self.suppressed.items())])
+        metric('dropped_total', 'counter', 'Datasets dropped by full callback queues.',
+               [(_labels({'callback': c}), n) for c, n in sorted(self.dropped().items())])
+        metric('wakeups_total', 'counter', 'Receiver wake ups.', [('', self.wakeups)])
+        metric('max_batch', 'gauge', 'Most datagrams read in one wake up.', [('', self.max_batch)])
+        histogram('latency_seconds', 'Time from packet arrival to callback.', [({}, self.latency)])
+        histogram('callback_seconds', 'Time spent in each callback.',
+                  [({'callback': name}, h) for name, h in sorted(self.callbacks.items())])
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _labels(labels, **extra):
+    items = sorted(labels.items()) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in items)
+
+
+class MetricsServer:
+    """
+    Serve the Prometheus text of a ReceiverStats on
+    http://host:port/metrics from a daemon thread.
+    """
+    def __init__(self, stats, host='127.0.0.1', port=9222, prefix='smartweather'):
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = stats.prometheus(prefix).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
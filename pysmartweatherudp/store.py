@@ -0,0 +1,75 @@
+""" Durable storage of the station states across restarts. """
+import json
+import os
+import time
+
+_replace = getattr(os, 'replace', os.rename)
+
+STORE_VERSION = 1
+
+
+class StateStore:
+    """
+    Saves the last known values and the daily precipitation accumulators
+    of every station to a small JSON file, and loads them at startup.
+
+    The file is written at most once every interval seconds from the
+    receive path, and when the receiver stops. Each checkpoint goes to a
+    temporary file that is synced once and then renamed over the old one,
+    so a crash leaves either the previous or the new checkpoint.
+    """
+    def __init__(self, path, interval=60, fsync=True):
+        self.path = path
+        self.interval = interval
+        self.fsync = fsync
+        self.units = None
+        self.checkpoints = 0
+        self._next = time.time() + interval
+
+    def load(self, stations, units):
+        """
+        Restore the saved stations into a StationTable, which publishes
+        their snapshots. Returns the count, 0 when the file is missing,
+        unreadable or not a checkpoint of this version and unit system.
+        """
+        self.units = units
+        try:
+            with open(self.path, 'r') as store:
+                saved = json.load(store)
+        except (IOError, OSError, ValueError):
+            return 0
+        if not isinstance(saved, dict):
+            # not a checkpoint
+            return 0
+        if saved.get('version') != STORE_VERSION or saved.get('units') != units:
+            # values were saved in another unit system
+            return 0
+        for values in saved.get('stations', ()):
+            stations.restore(values)
+        return len(saved.get('stations', ()))
+
+    def tick(self, stations):
+        """ Save a checkpoint when the interval has passed. """
+        now = time.time()
+        if now >= self._next:
+            self.checkpoint(stations, now)
+
+    def checkpoint(self, stations, now=None):
+        """ Write the station states to disk. """
+        if now is None:
+            now = time.time()
+        self._next = now + self.interval
+        saved = {
+            'version': STORE_VERSION,
+            'units': self.units,
+            'time': now,
+            'stations': [state.asDict() for state in stations],
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as store:
+            json.dump(saved, store)
+            store.flush()
+            if self.fsync:
+                os.fsync(store.fileno())
+        _replace(tmp, self.path)
+        self.checkpoints += 1
@@ -1,160 +1,355 @@
 """ Utility Functions used with pysmartweatherudp. """
 import datetime
 import json
-import math
+
+from . import metrics
+from .constants import RAW_UNITS
 
 
 def getDataSet(data, units, ignore_errors=False):
     """ Returns a the specic dataset from raw data. """
     try:
         jsondata = json.loads(data)
-
-        if jsondata['type'] == 'rapid_wind':
-            return RapidWind(jsondata['ob'], units)
-        elif jsondata['type'] == 'obs_sky':
-            return SkyOberservation(jsondata['obs'][0], units)
-        elif jsondata['type'] == 'obs_air':
-            return AirOberservation(jsondata['obs'][0], units)
-        elif jsondata['type'] == 'obs_st':
-            return StObservation(jsondata['obs'][0], units)
-        else:
-            return None
+        return buildDataSet(jsondata, getConverters(units))
     except:
         if not ignore_errors:
             raise
 
-class StObservation:
+def buildDataSet(jsondata, conv):
+    """ Returns the dataset for the first row of a parsed packet, or None. """
+    handler = DATASET_TYPES.get(jsondata.get('type'))
+    if handler is None:
+        return None
+    cls, key, first = handler
+    data = jsondata[key]
+    ds = cls(data[0] if first else data, conv)
+    ds.serial_number = jsondata.get('serial_number')
+    ds.hub_sn = jsondata.get('hub_sn')
+    return ds
+
+# Field schema shared by every observation
+AIR_FIELDS = (
+    'pressure', 'temperature', 'humidity', 'lightning_count',
+    'lightning_distance', 'lightning_time', 'airbattery', 'dewpoint',
+    'heat_index',
+)
+SKY_FIELDS = (
+    'illuminance', 'uv', 'precipitation', 'precipitation_rate', 'wind_speed',
+    'wind_bearing', 'wind_lull', 'wind_gust', 'skybattery', 'solar_radiation',
+    'wind_direction',
+)
+# Sky fields measured by the device, precipitation is accumulated
+SKY_MEASURED_FIELDS = tuple(f for f in SKY_FIELDS if f not in ('precipitation', 'precipitation_rate'))
+RAPID_WIND_FIELDS = ('wind_speed_rapid', 'wind_bearing_rapid')
+CALCULATED_FIELDS = ('wind_chill', 'feels_like')
+# Rolling rapid_wind statistics, a dictionary of WindSummary by window
+ROLLING_FIELDS = ('wind_windows',)
+# Registered additional metrics, a dictionary by name
+METRIC_FIELDS = ('metrics',)
+STATE_FIELDS = AIR_FIELDS + SKY_FIELDS + RAPID_WIND_FIELDS + CALCULATED_FIELDS
+FIELDS = ('type', 'timestamp', 'serial_number', 'hub_sn') + STATE_FIELDS + ROLLING_FIELDS + METRIC_FIELDS
+
+_NONE_FIELDS = ('type', 'serial_number', 'hub_sn', 'lightning_time', 'wind_direction', 'wind_windows',
+                'metrics')
+# Fields of a packet, set on every dataset
+_DEFAULTS = tuple((f, None if f in _NONE_FIELDS else 0) for f in FIELDS
+                  if f not in STATE_FIELDS + ROLLING_FIELDS)
+# Fields of the station, read from its state unless the packet carries them
+_STATE_NAMES = STATE_FIELDS + ROLLING_FIELDS
+_STATE_DEFAULTS = dict((f, None if f in _NONE_FIELDS else 0) for f in _STATE_NAMES)
+# Station fields the merge sets on a dataset besides the ones of its packet
+_MERGED_FIELDS = ('precipitation', 'wind_windows') + CALCULATED_FIELDS
+
+# Fields in WeatherFlow units, with the converter each one goes through
+UNIT_FIELDS = (
+    ('pressure', 'pressure'),
+    ('lightning_distance', 'distance'),
+    ('precipitation', 'rain_total'),
+    ('precipitation_rate', 'rain_rate'),
+    ('wind_speed', 'speed'),
+    ('wind_lull', 'speed'),
+    ('wind_gust', 'speed'),
+    ('wind_speed_rapid', 'speed'),
+)
+# The same for SKY and Tempest packets, whose own precipitation_rate is
+# the rain of the last minute rather than the hourly rate of the state
+CARRIED_RAIN_UNIT_FIELDS = tuple((name, 'volume' if name == 'precipitation_rate' else kind)
+                                 for name, kind in UNIT_FIELDS)
+
+def copyFields(target, source, fields):
+    """ Copy the named fields from one object to another. """
+    for name in fields:
+        setattr(target, name, getattr(source, name))
+
+def convertWindows(windows, conv):
+    """ Returns rolling wind summaries with their speeds converted from m/s. """
+    speed = conv.speed
+    return dict(
+        (window, summary._replace(average=speed(summary.average), gust=speed(summary.gust),
+                                  lull=speed(summary.lull)))
+        for window, summary in windows.items())
+
+class UnitViews(object):
+    """
+    A dataset decoded in raw units that hands out copies converted to a
+    unit system. The copy for a unit system is made on first use and
+    kept, so every consumer in that unit system shares it. Subclasses
+    list their converted fields in unit_fields and keep the copies in
+    a _views slot.
+    """
+    __slots__ = ()
+    unit_fields = ()
+
+    def inUnits(self, units):
+        """ Returns the dataset in a unit system, itself for raw units. """
+        conv = getConverters(units)
+        if conv.raw or not self.unit_fields:
+            return self
+        views = self._views
+        if views is None:
+            views = self._views = {}
+        view = views.get(conv)
+        if view is None:
+            view = self.copy()
+            view.convert(conv)
+            views[conv] = view
+        return view
+
+    def convert(self, conv):
+        """ Convert the unit fields in place from raw units. """
+        for name, kind in self.unit_fields:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, getattr(conv, kind)(value))
+
+class Observation(UnitViews):
+    """
+    A dataset with a fixed layout. Every message type uses the same
+    fields. The ones a packet does not carry are read from the station
+    snapshot the dataset was merged with, in _state, rather than copied
+    into it; they are zero or None for a dataset that was not merged.
+    Datasets are shared by the callbacks and must not be changed.
+    """
+    __slots__ = FIELDS + ('_views', '_state')
+    unit_fields = UNIT_FIELDS
+    # Station fields the packet carries, set by the subclasses
+    carried = ()
+
+    def __init__(self):
+        for name, value in _DEFAULTS:
+            setattr(self, name, value)
+        self._views = None
+        self._state = None
+
+    def __getattr__(self, name):
+        # only called for the fields this dataset has not set
+        try:
+            default = _STATE_DEFAULTS[name]
+        except KeyError:
+            raise AttributeError(name)
+        state = self._state
+        if state is None:
+            return default
+        return getattr(state, name)
+
+    def __getstate__(self):
+        # the station snapshot is not sent along, its fields are
+        return self.asDict()
+
+    def __setstate__(self, values):
+        for name, value in values.items():
+            setattr(self, name, value)
+        self._views = None
+        self._state = None
+
+    def copyFrom(self, source, fields=STATE_FIELDS):
+        """ Copy fields from another observation or a station state. """
+        copyFields(self, source, fields)
+
+    def copy(self):
+        """ Returns a copy of the observation, with the fields of its snapshot. """
+        ds = self.__class__.__new__(self.__class__)
+        state = self._state
+        if state is None:
+            copyFields(ds, self, FIELDS)
+        else:
+            # straight from the snapshot, rather than through __getattr__
+            copyFields(ds, state, _STATE_NAMES)
+            copyFields(ds, self, self._own)
+        ds._views = None
+        ds._state = None
+        return ds
+
+    def convert(self, conv):
+        UnitViews.convert(self, conv)
+        if self.wind_windows:
+            self.wind_windows = convertWindows(self.wind_windows, conv)
+
+    def asDict(self):
+        """ Returns the fields as a dictionary. """
+        state = self._state
+        if state is None:
+            return dict((name, getattr(self, name)) for name in FIELDS)
+        values = dict((name, getattr(state, name)) for name in _STATE_NAMES)
+        values.update((name, getattr(self, name)) for name in self._own)
+        return values
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.serial_number, self.timestamp)
+
+class StObservation(Observation):
     """ Return the Combined Station data Structure. """
-    def __init__(self, data, units):
+    __slots__ = ()
+    unit_fields = CARRIED_RAIN_UNIT_FIELDS
+    carried = AIR_FIELDS + SKY_FIELDS
+
+    def __init__(self, data, units, derived=True):
+        Observation.__init__(self)
+        conv = getConverters(units)
         # Rapid Wind Data
         self.type = 'st'
         self.timestamp = data[0]
         self.illuminance = data[9]
         self.uv = data[10]
-        self.precipitation_rate = UnitConversion.volume(self, data[12], units)
-        self.wind_speed = UnitConversion.speed(self, data[2], units)
+        self.precipitation_rate = conv.volume(data[12])
+        self.wind_speed = conv.speed(data[2])
         self.wind_bearing = data[4]
-        self.wind_lull = UnitConversion.speed(self, data[1], units)
-        self.wind_gust = UnitConversion.speed(self, data[2], units)
+        self.wind_lull = conv.speed(data[1])
+        self.wind_gust = conv.speed(data[2])
         self.skybattery = data[16]
         self.solar_radiation = data[11]
-        self.wind_direction = UnitConversion.wind_direction(self, data[4])
+        self.wind_direction = conv.wind_direction(data[4])
         # Air Data
-        self.pressure = UnitConversion.pressure(self, data[6], units)
+        self.pressure = conv.pressure(data[6])
         self.temperature = round(data[7],1)
         self.humidity = data[8]
         self.lightning_count = data[15]
-        self.lightning_distance = UnitConversion.distance(self, data[14], units)
+        self.lightning_distance = conv.distance(data[14])
         self.lightning_time = datetime.datetime.today().strftime('%Y-%m-%d') if data[15] > 0 else None
         self.airbattery = data[16]
-        self.dewpoint = WeatherFunctions.getDewPoint(self, data[7], data[8])
-        self.heat_index = WeatherFunctions.getHeatIndex(self, data[7], data[8])
-        # Rapid Wind Data
-        self.wind_speed_rapid = 0
-        self.wind_bearing_rapid = 0
-        # Calculated Values
-        self.wind_chill = 0
-        self.feels_like = 0
+        if derived:
+            self.dewpoint = metrics.dewPoint(data[7], data[8])
+            self.heat_index = metrics.heatIndex(data[7], data[8])
 
-class RapidWind:
+class RapidWind(Observation):
     """ Return the Rapid Wind data Structure. """
+    __slots__ = ()
+    carried = RAPID_WIND_FIELDS
+
     def __init__(self, data, units):
+        Observation.__init__(self)
+        conv = getConverters(units)
         # Rapid Wind Data
         self.type = 'rapid_wind'
         self.timestamp = data[0]
-        self.wind_speed_rapid = UnitConversion.speed(self, data[1], units)
+        self.wind_speed_rapid = conv.speed(data[1])
         self.wind_bearing_rapid = data[2]
-        # Air Data
-        self.pressure = 0
-        self.temperature = 0
-        self.humidity = 0
-        self.lightning_count = 0
-        self.lightning_distance = 0
-        self.lightning_time = None
-        self.airbattery = 0
-        self.dewpoint = 0
-        self.heat_index = 0
-        # Sky Data
-        self.illuminance = 0
-        self.uv = 0
-        self.precipitation_rate = 0
-        self.wind_speed = 0
-        self.wind_bearing = 0
-        self.wind_lull = 0
-        self.wind_gust = 0
-        self.skybattery = 0
-        self.solar_radiation = 0
-        self.wind_direction = None
-        # Calculated Values
-        self.wind_chill = 0
-        self.feels_like = 0
-
-class SkyOberservation:
+
+class SkyOberservation(Observation):
     """ Returns the SKY Observation Dataset. """
+    __slots__ = ()
+    unit_fields = CARRIED_RAIN_UNIT_FIELDS
+    carried = SKY_FIELDS
+
     def __init__(self, data, units):
+        Observation.__init__(self)
+        conv = getConverters(units)
         # Sky Data
         self.type = 'sky'
         self.timestamp = data[0]
         self.illuminance = data[1]
         self.uv = data[2]
-        self.precipitation_rate = UnitConversion.volume(self, data[3], units)
-        self.wind_speed = UnitConversion.speed(self, data[5], units)
+        self.precipitation_rate = conv.volume(data[3])
+        self.wind_speed = conv.speed(data[5])
         self.wind_bearing = data[7]
-        self.wind_lull = UnitConversion.speed(self, data[4], units)
-        self.wind_gust = UnitConversion.speed(self, data[6], units)
+        self.wind_lull = conv.speed(data[4])
+        self.wind_gust = conv.speed(data[6])
         self.skybattery = data[8]
         self.solar_radiation = data[10]
-        self.wind_direction = UnitConversion.wind_direction(self, data[7])
-        # Air Data
-        self.pressure = 0
-        self.temperature = 0
-        self.humidity = 0
-        self.lightning_count = 0
-        self.lightning_distance = 0
-        self.lightning_time = None
-        self.airbattery = 0
-        self.dewpoint = 0
-        self.heat_index = 0
-        # Rapid Wind Data
-        self.wind_speed_rapid = 0
-        self.wind_bearing_rapid = 0
-        # Calculated Values
-        self.wind_chill = 0
-        self.feels_like = 0
+        self.wind_direction = conv.wind_direction(data[7])
 
-class AirOberservation:
+class AirOberservation(Observation):
     """ Returns the AIR Observation Dataset. """
-    def __init__(self, data, units):
+    __slots__ = ()
+    carried = AIR_FIELDS
+
+    def __init__(self, data, units, derived=True):
+        Observation.__init__(self)
+        conv = getConverters(units)
         # Air Data
         self.type = 'air'
         self.timestamp = data[0]
-        self.pressure = UnitConversion.pressure(self, data[1], units)
+        self.pressure = conv.pressure(data[1])
         self.temperature = round(data[2],1)
         self.humidity = data[3]
         self.lightning_count = data[4]
-        self.lightning_distance = UnitConversion.distance(self, data[5], units)
+        self.lightning_distance = conv.distance(data[5])
         self.lightning_time = datetime.datetime.today().strftime('%Y-%m-%d') if data[4] > 0 else None
         self.airbattery = data[6]
-        self.dewpoint = WeatherFunctions.getDewPoint(self, data[2], data[3])
-        self.heat_index = WeatherFunctions.getHeatIndex(self, data[2], data[3])
-        # Sky Data
-        self.illuminance = 0
-        self.uv = 0
-        self.precipitation_rate = 0
-        self.wind_speed = 0
-        self.wind_bearing = 0
-        self.wind_lull = 0
-        self.wind_gust = 0
-        self.skybattery = 0
-        self.solar_radiation = 0
-        self.wind_direction = None
-        # Rapid Wind Data
-        self.wind_speed_rapid = 0
-        self.wind_bearing_rapid = 0
-        # Calculated Values
-        self.wind_chill = 0
-        self.feels_like = 0
-        
+        if derived:
+            self.dewpoint = metrics.dewPoint(data[2], data[3])
+            self.heat_index = metrics.heatIndex(data[2], data[3])
+
+# Fields read from a merged dataset itself rather than from its snapshot
+for _cls in (Observation, StObservation, RapidWind, SkyOberservation, AirOberservation):
+    _cls._own = tuple(name for name, _ in _DEFAULTS) + _cls.carried + _MERGED_FIELDS
+
+DATASET_TYPES = {
+    # type: (dataset class, json key, carries an array of rows)
+    'rapid_wind': (RapidWind, 'ob', False),
+    'obs_sky': (SkyOberservation, 'obs', True),
+    'obs_air': (AirOberservation, 'obs', True),
+    'obs_st': (StObservation, 'obs', True),
+}
+
+DIRECTION_ARRAY = ['N','NNE','NE','ENE','E','ESE','SE','SSE','S','SSW','SW','WSW','W','WNW','NW','NNW','N']
+
+def windDirection(bearing):
+    """ Returns the bearing as directional text. """
+    return DIRECTION_ARRAY[int((bearing + 11.25) / 22.5)]
+
+class Converters:
+    """
+    Conversion functions resolved once for a unit system, so the
+    per packet code does not have to look at the unit string again.
+    """
+    def __init__(self, units):
+        self.units = units
+        self.raw = units.lower() == RAW_UNITS
+        self.wind_direction = windDirection
+        if self.raw:
+            # as sent, mm, mb, m/s, km
+            self.volume = self.pressure = self.speed = self.distance = lambda value: value
+            self.rain_total = self.rain_rate = self.volume
+        elif units.lower() == 'imperial':
+            # in, inHg, mi/h, mi
+            self.volume = lambda value: value * 0.0393700787
+            # the daily total and hourly rate are rounded again once in inches
+            self.rain_total = lambda value: round(value * 0.0393700787,1)
+            self.rain_rate = lambda value: round(value * 0.0393700787,2)
+            self.pressure = lambda value: round(value * 0.0295299801647,3)
+            self.speed = lambda value: round(value*2.2369362921,1)
+            self.distance = lambda value: round(value*0.621371192,1)
+        else:
+            # mm, mb, m/s, km
+            self.volume = lambda value: value
+            # the state rounds them in mm already
+            self.rain_total = self.rain_rate = self.volume
+            self.pressure = lambda value: round(value,1)
+            self.speed = lambda value: round(value,1)
+            self.distance = lambda value: round(value,0)
+
+_converters = {}
+
+def getConverters(units):
+    """ Returns the cached Converters for a unit system. """
+    if isinstance(units, Converters):
+        return units
+    conv = _converters.get(units)
+    if conv is None:
+        conv = _converters[units] = Converters(units)
+    return conv
+
 class UnitConversion:
     """
     Conversion Class to convert between different units.
@@ -166,95 +361,34 @@ class UnitConversion:
     Distance: km
     """
     def volume(self, value, unit):
-        if unit.lower() == 'imperial':
-            # Return value in
-            return value * 0.0393700787
-        else:
-            # Return value mm
-            return value
+        return getConverters(unit).volume(value)
 
     def pressure(self, value, unit):
-        if unit.lower() == 'imperial':
-            # Return value inHg
-            return round(value * 0.0295299801647,3)
-        else:
-            # Return value mb
-            return round(value,1)
+        return getConverters(unit).pressure(value)
 
     def speed(self, value, unit):
-        if unit.lower() == 'imperial':
-            # Return value in mi/h
-            return round(value*2.2369362921,1)
-        else:
-            # Return value in m/s
-            return round(value,1)
+        return getConverters(unit).speed(value)
 
     def distance(self, value, unit):
-        if unit.lower() == 'imperial':
-            # Return value in mi
-            return round(value*0.621371192,1)
-        else:
-            # Return value in m/s
-            return round(value,0)
+        return getConverters(unit).distance(value)
 
     def wind_direction(self, bearing):
-        direction_array = ['N','NNE','NE','ENE','E','ESE','SE','SSE','S','SSW','SW','WSW','W','WNW','NW','NNW','N']
-        direction = direction_array[int((bearing + 11.25) / 22.5)]
-        return direction
+        return windDirection(bearing)
 
 class WeatherFunctions:
-    """ Weather Specific Math Functions. """
+    """ Weather Specific Math Functions. Kept for compatibility, see metrics. """
     def getDewPoint(self, temperature, humidity):
         """ Returns Dew Point in Celcius """
-        return round(243.04*(math.log(humidity/100)+((17.625*temperature)/(243.04+temperature)))/(17.625-math.log(humidity/100)-((17.625*temperature)/(243.04+temperature))),1)
+        return metrics.dewPoint(temperature, humidity)
 
     def getWindChill(self, wind_speed, temperature):
         """ Returns Wind Chill in Celcius """
-        if wind_speed < 1.3:
-            return round(temperature,1)
-        else:
-            windKmh = wind_speed * 3.6
-            return round(13.12 + (0.6215 * temperature) - (11.37 * math.pow(windKmh, 0.16)) + (0.3965 * temperature * math.pow(windKmh, 0.16)), 1)
+        return metrics.windChill(wind_speed, temperature)
 
     def getHeatIndex(self, temperature, humidity):
         """ Returns Heat Index in Celcius """
-        T = temperature * 9/5 + 32 #Convert to Fahrenheit
-        RH = humidity
-        c1 = -42.379
-        c2 = 2.04901523
-        c3 = 10.14333127
-        c4 = -0.22475541
-        c5 = -6.83783e-3
-        c6 = -5.481717e-2
-        c7 = 1.22874e-3
-        c8 = 8.5282e-4
-        c9 = -1.99e-6
-
-        # try simplified formula first (used for HI < 80)
-        HI = 0.5 * (T + 61. + (T - 68.) * 1.2 + RH * 0.094)
-
-        if HI >= 80:
-            # use Rothfusz regression
-            HI = math.fsum([
-                c1,
-                c2 * T,
-                c3 * RH,
-                c4 * T * RH,
-                c5 * T**2,
-                c6 * RH**2,
-                c7 * T**2 * RH,
-                c8 * T * RH**2,
-                c9 * T**2 * RH**2,
-            ])
-
-        # Return value in Celcius
-        return round((HI - 32) * 5/9, 1)
+        return metrics.heatIndex(temperature, humidity)
 
     def getFeelsLike(self, temperature, wind_chill, heat_index):
         """ Returns the Feels Like Temperature in Celcius """
-        if temperature > 26.666666667:
-            return heat_index
-        elif temperature < 10:
-            return wind_chill
-        else:
-            return round(temperature,1)
+        return metrics.feelsLike(temperature, wind_chill, heat_index)
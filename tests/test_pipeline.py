@@ -0,0 +1,99 @@
+""" Duplicate, late, stale and future observation rows in the pipeline. """
+import json
+import time
+import unittest
+
+from pysmartweatherudp.pipeline import Pipeline
+
+# A past day, so no row is ahead of the local clock unless meant to be
+START = 1700000000
+
+
+def sky(*rows):
+    """ Returns an obs_sky packet, rows of (timestamp, rain in mm). """
+    return json.dumps({
+        'serial_number': 'SK-00000001', 'type': 'obs_sky', 'hub_sn': 'HB-00000001',
+        'obs': [[timestamp, 1000, 2, rain, 1.2, 2.3, 3.4, 180, 3.5, 1, 130, None, 0, 3]
+                for timestamp, rain in rows],
+        'firmware_revision': 29})
+
+
+def air(timestamp, temperature):
+    """ Returns an obs_air packet with one row. """
+    return json.dumps({
+        'serial_number': 'AR-00000001', 'type': 'obs_air', 'hub_sn': 'HB-00000001',
+        'obs': [[timestamp, 1000, temperature, 50, 0, 0, 3.0, 1]],
+        'firmware_revision': 17})
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pipeline = Pipeline('metric')
+        self.datasets = []
+        self.pipeline.registerCallback(self.datasets.append)
+
+    def snapshot(self):
+        return self.pipeline.snapshot('HB-00000001')
+
+    def test_repeated_packet_counts_rain_once(self):
+        self.pipeline.handle(sky((START, 1.0)))
+        self.pipeline.handle(sky((START, 1.0)))
+        self.assertEqual(len(self.datasets), 1)
+        self.assertEqual(self.pipeline.stats.suppressed, {'duplicate': 1})
+        self.assertEqual(self.snapshot().precipitation, 1.0)
+
+    def test_overlapping_rows_count_rain_once(self):
+        self.pipeline.handle(sky((START, 1.0), (START + 60, 1.0)))
+        # same rows again, then a new one, in a different packet
+        self.pipeline.handle(sky((START + 60, 1.0), (START + 120, 1.0)))
+        self.assertEqual([ds.timestamp for ds in self.datasets], [START, START + 60, START + 120])
+        self.assertEqual(self.pipeline.stats.suppressed, {'duplicate': 1})
+        self.assertEqual(self.snapshot().precipitation, 3.0)
+
+    def test_late_row_adds_rain_but_keeps_newer_values(self):
+        self.pipeline.handle(air(START + 60, 12.5))
+        self.pipeline.handle(air(START, 10.0))
+        self.assertEqual(self.pipeline.stats.late, 1)
+        self.assertEqual(self.datasets[-1].temperature, 10.0)
+        self.assertEqual(self.snapshot().temperature, 12.5)
+        self.assertEqual(self.snapshot().timestamp, START + 60)
+
+        self.pipeline.handle(sky((START + 60, 1.0)))
+        self.pipeline.handle(sky((START, 0.5)))
+        self.assertEqual(self.pipeline.stats.late, 2)
+        self.assertEqual(self.datasets[-1].precipitation, 1.5)
+        self.assertEqual(self.snapshot().precipitation, 1.5)
+        self.assertEqual(self.snapshot().timestamp, START + 60)
+
+    def test_stale_row_is_dropped(self):
+        self.pipeline.handle(sky((START + 600, 1.0)))
+        self.pipeline.handle(sky((START, 0.5)))
+        self.assertEqual(len(self.datasets), 1)
+        self.assertEqual(self.pipeline.stats.suppressed, {'stale': 1})
+        self.assertEqual(self.snapshot().precipitation, 1.0)
+
+    def test_future_row_does_not_block_the_device(self):
+        future = int(time.time()) + 365 * 86400
+        self.pipeline.handle(air(START, 10.0))
+        self.pipeline.handle(air(future, 99.0))
+        for minute in range(1, 5):
+            self.pipeline.handle(air(START + 60 * minute, 10.0 + minute))
+        self.assertEqual(self.pipeline.stats.suppressed, {'future': 1})
+        self.assertEqual(self.pipeline.stats.late, 0)
+        self.assertEqual(len(self.datasets), 5)
+        self.assertEqual(self.snapshot().temperature, 14.0)
+
+    def test_future_row_without_dedup(self):
+        pipeline = Pipeline('metric', dedup_window=None)
+        future = int(time.time()) + 365 * 86400
+        pipeline.handle(sky((START, 1.0)))
+        pipeline.handle(sky((future, 5.0)))
+        pipeline.handle(sky((START + 60, 1.0)))
+        self.assertEqual(pipeline.stats.suppressed, {'future': 1})
+        self.assertEqual(pipeline.stats.late, 0)
+        self.assertEqual(pipeline.snapshot('HB-00000001').precipitation, 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()